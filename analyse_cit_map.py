@@ -4,11 +4,12 @@ pool_size = 12
 
 import json
 import pandas as pd
+import numpy as np
 from citation_resolution.create_evaluation_sheet import loop_through_ms
-from utilities.clusterDf import clusterDf
+from utilities.clusterDf import clusterDf, ms_bitmap
+from utilities.openitiTexts import openitiCorpus, resolve_text_path
 from tqdm import tqdm
 import re
-import os
 from openiti.helper.ara import normalize_ara_heavy 
 from openiti.helper.funcs import text_cleaner
 if multiprocess:
@@ -120,23 +121,28 @@ def identify_continuous_cited_ms(cit_map, cluster_obj, main_book_uri, all_cits=T
     out_df = out_df.drop_duplicates()
     return out_df
 
-def find_unresolved_ms(full_ms_df, ms_matched, data_type = 'ms_df'):
-    full_ms_list = full_ms_df["ms"].astype('int32').to_list()
+def find_unresolved_ms(full_ms_df, ms_matched, data_type = 'ms_df', coverage = None):
+    """Return the ms of full_ms_df that are not in ms_matched
+    coverage: optional milestone coverage array for the text (clusterDf.ms_coverage) - if given, also report how many
+    of the unmatched ms are aligned with other texts
+    Membership is tested on milestone bitmaps (see clusterDf.ms_bitmap) rather than with list lookups"""
+    full_ms = full_ms_df["ms"].astype('int32').to_numpy()
     if data_type == 'cit_map':
         ms_matched_list = []
         for uri in ms_matched.keys():
-            data=ms_matched[uri]["cit_ms"]
-            for ms in data:
-                if ms not in ms_matched_list:
-                    ms_matched_list.append(ms)
+            ms_matched_list.extend(ms_matched[uri]["cit_ms"])
     else:    
         ms_matched_list = ms_matched["ms"].to_list()
-    
-    unmatched = []
-    for ms in full_ms_list:
-        if ms not in ms_matched_list:
-            unmatched.append(ms)
-    print("Of {} total ms {} are not matched".format(len(full_ms_list), len(unmatched)))
+
+    n_ms = int(full_ms.max()) if len(full_ms) > 0 else 0
+    matched = ms_bitmap(ms_matched_list, n_ms=n_ms)
+    unmatched_mask = ~matched[full_ms]
+    unmatched = full_ms[unmatched_mask].tolist()
+    print("Of {} total ms {} are not matched".format(len(full_ms), len(unmatched)))
+    if coverage is not None:
+        aligned = ms_bitmap(np.flatnonzero(coverage), n_ms=n_ms)
+        unmatched_aligned = unmatched_mask & aligned[full_ms]
+        print("Of the {} unmatched ms {} are aligned with other texts".format(len(unmatched), int(unmatched_aligned.sum())))
     return unmatched
 
 def search_text_for_cits(text, cit_map, arg2=None, arg3=None):
@@ -170,31 +176,15 @@ def normalize_cit_dict(cit_dict):
 
 
 def check_uri_extension(uri_path):
-    extensions = ['inProgress', 'completed', 'mARkdown']
-    path_found = False
-    if os.path.isfile(uri_path):
-        path_found = True
-        return uri_path
-    else:
-        split_path = uri_path.split(".")
-        if split_path[-1] in extensions:
-            pre_extension = ".".join(split_path[:-1])
-            if os.path.isfile(pre_extension):
-                path_found = True
-                return pre_extension
-        else:
-            pre_extension = uri_path
-        for extension in extensions:
-            potential_path = pre_extension + "." + extension
-            if os.path.isfile(potential_path):
-                path_found = True
-                return potential_path
-    if not path_found:
-        return None
+    return resolve_text_path(uri_path)
 
 def text_path_to_results(text_path, uri_cit_list):        
     print(text_path)
-    verified_path = check_uri_extension(text_path["full_path"])
+    # Paths from the corpus text index have already been checked
+    if "resolved_path" in text_path:
+        verified_path = text_path["resolved_path"]
+    else:
+        verified_path = check_uri_extension(text_path["full_path"])
     if verified_path is None:
         print("No related path found")
     else:
@@ -214,17 +204,18 @@ def text_path_to_results(text_path, uri_cit_list):
         return(results_df)
 
 
-def query_cit_map_corpus(main_book_uri, cit_map, cluster_obj, corpus_base_path, meta_path):
+def query_cit_map_corpus(main_book_uri, cit_map, cluster_obj, corpus_base_path, meta_path, corpus = None):
     """A function that queries books aligned with a main_text with the verified citations found in that main text
-    Can be used later to lookup clusters and provide potential source resolutions"""
+    Can be used later to lookup clusters and provide potential source resolutions
+    corpus: an openitiCorpus (of primary texts, not filtered by date) to take the paths from - built if not given.
+    Only the paths of the aligned books are checked on the filesystem"""
 
     # Use the clusters to fetch a list of books - get the paths
     aligned_books = cluster_obj.return_cluster_df_for_uri_ms(main_book_uri)["book"].drop_duplicates().to_list()
-    meta_df = pd.read_csv(meta_path, sep="\t")
-    meta_df = meta_df[meta_df["status"] == "pri"]    
-    meta_filtered = meta_df[meta_df["book"].isin(aligned_books)]
-    meta_filtered["full_path"] = corpus_base_path + meta_filtered["local_path"].str.split("..", expand=True, regex=False)[1]
-    text_paths = meta_filtered[["book", "full_path"]].to_dict("records")
+    if corpus is None:
+        corpus = openitiCorpus(meta_path, corpus_base_path, pri_only=True, min_date=None, max_date=None)
+    text_index = corpus.text_index(aligned_books)
+    text_paths = text_index[["book", "full_path", "resolved_path"]].to_dict("records")
     
 
     # Use the cit map to build a set of regex search terms in a list of dicts
@@ -346,7 +337,7 @@ def infer_source_from_aligned_citation(corpus_citations, verified_citations, clu
 
 
 
-def analyse_cit_map(cit_map, main_text, cluster_data, meta_path, main_book_uri, corpus_base_path, verified_csv = None, corpus_citations = None, corpus_citations_continuous = None):
+def analyse_cit_map(cit_map, main_text, cluster_data, meta_path, main_book_uri, corpus_base_path, verified_csv = None, corpus_citations = None, corpus_citations_continuous = None, cache_dir = None):
     """Experimental functions to try out ways of converting the cit_map into models of lost text use
     Output finding as a reuse map that can be fed into cluster graphing scripts for reuse maps"""
 
@@ -367,7 +358,7 @@ def analyse_cit_map(cit_map, main_text, cluster_data, meta_path, main_book_uri,
     ms_df = pd.DataFrame(ms_dict)
 
     # Create cluster_obj with the minified clusters
-    cluster_obj = clusterDf(cluster_data, meta_path)
+    cluster_obj = clusterDf(cluster_data, meta_path, cache_dir=cache_dir)
     
 
     # Seperate ms that have a verified citation - or follow from a verified citation - this includes texts for which the author can be linked to an author uri, but for which we might posit a lost text
@@ -380,7 +371,8 @@ def analyse_cit_map(cit_map, main_text, cluster_data, meta_path, main_book_uri,
         verified_df.to_csv("outputs_4/verified{}.csv".format(main_book_uri))
     
     # Fetch ms that have no verified source
-    unmatched_ms = find_unresolved_ms(ms_df, verified_df)
+    coverage = cluster_obj.ms_coverage(main_book_uri)
+    unmatched_ms = find_unresolved_ms(ms_df, verified_df, coverage=coverage)
 
     # Search aligned text for verified citations
     if not corpus_citations:
@@ -401,7 +393,7 @@ def analyse_cit_map(cit_map, main_text, cluster_data, meta_path, main_book_uri,
     aligned_cit_df = infer_source_from_aligned_citation(corpus_citations_df, verified_df, cluster_obj, main_book_uri)
     aligned_cit_df.to_csv("outputs_4/citations_with_aligned.csv")
 
-    unmatched_ms = find_unresolved_ms(ms_df, aligned_cit_df)
+    unmatched_ms = find_unresolved_ms(ms_df, aligned_cit_df, coverage=coverage)
 
     # For lost texts with an evaluated citation - look-up corpus citations - create groups of books who had access to the lost text in question
 
@@ -1,5 +1,6 @@
 from citation_resolution.create_evaluation_sheet import loop_through_ms
 from utilities.clusterDf import clusterDf
+from utilities.metaIndex import read_meta_index
 import pandas as pd
 from tqdm import tqdm
 
@@ -11,30 +12,37 @@ def fetch_top_reusers_for_uncited(citation_df, cluster_obj, main_text_path, main
     
     ms_dict = loop_through_ms(text, ms_as_int=True)
     ms_list = pd.DataFrame(ms_dict)["ms"].to_list()
-    ms_matched = citation_df["ms"].to_list()
+    ms_matched = set(citation_df["ms"].to_list())
+    ms_unmatched = [ms for ms in ms_list if not ms in ms_matched]
+
+    # Number of reusers of each milestone - only the milestones with reuse need their clusters fetched
+    reuser_counts = cluster_obj.ms_coverage(main_book_uri, weighted=True, n_ms=max(ms_list, default=0))
+    ms_reused = [int(ms) for ms in ms_unmatched if reuser_counts[ms] > 0]
+
+    # Fetch the clusters for every reused unmatched milestone in one call - rows are tagged with the milestone (query_ms)
+    batch_df = cluster_obj.return_cluster_df_for_uri_ms_batch(ms_reused, primary_book=main_book_uri)
+    batch_df = batch_df[batch_df["book"] != main_book_uri][["query_ms", "book"]].drop_duplicates()
+    ms_books = batch_df.groupby("query_ms", sort=False)["book"].agg(list).to_dict()
 
     # Create a dictionary listing main_text milestones for each reuser
     reuser_dict = {}
     non_reuse = []
     ms_reuser_list = []
-    for ms in tqdm(ms_list):
-        if not ms in ms_matched:
-            book_df = cluster_obj.return_cluster_df_for_uri_ms(main_book_uri, int(ms))
-            book_df = book_df[book_df["book"] != main_book_uri]
-            book_list = book_df["book"].drop_duplicates().to_list()            
-            if len(book_list) == 0:
-                non_reuse.append(ms)
-            else:
-                for book in book_list:
-                    if book not in reuser_dict.keys():
-                        reuser_dict[book] = [ms]
-                    else:
-                        if ms not in reuser_dict[book]:
-                            reuser_dict[book].append(ms)
-
-            # Add count of books to ms_reuser_list and list of books
-            row = {"ms": ms, "reuser_count": len(book_list), "reusers": book_list}
-            ms_reuser_list.append(row)
+    for ms in tqdm(ms_unmatched):
+        book_list = ms_books.get(int(ms), [])
+        if len(book_list) == 0:
+            non_reuse.append(ms)
+        else:
+            for book in book_list:
+                if book not in reuser_dict.keys():
+                    reuser_dict[book] = [ms]
+                else:
+                    if ms not in reuser_dict[book]:
+                        reuser_dict[book].append(ms)
+
+        # Add count of books to ms_reuser_list and list of books
+        row = {"ms": ms, "reuser_count": len(book_list), "reusers": book_list}
+        ms_reuser_list.append(row)
     
     reuser_df = pd.DataFrame(ms_reuser_list)
 
@@ -109,12 +117,13 @@ def count_lost_sources(citation_df, meta_df):
 
 
 
-def analyse_cits(citation_csv, cluster_path, meta_path, main_text_path, main_book_uri):
-    """Main script for analysis"""
+def analyse_cits(citation_csv, cluster_path, meta_path, main_text_path, main_book_uri, cache_dir = None):
+    """Main script for analysis
+    cache_dir: optional clusterCache directory used to reuse the filtered cluster data between runs"""
 
-    cluster_obj = clusterDf(cluster_path, meta_path)
+    cluster_obj = clusterDf(cluster_path, meta_path, cache_dir=cache_dir)
     citation_df = pd.read_csv(citation_csv)
-    meta_df = pd.read_csv(meta_path, sep='\t')
+    meta_df = read_meta_index(meta_path, ["book", "author_from_uri"])
 
     fetch_source_counts(citation_df).to_csv("outputs_4/cited_source_counts.csv")
     top_reusers, ms_reusers = fetch_top_reusers_for_uncited(citation_df, cluster_obj, main_text_path, main_book_uri)
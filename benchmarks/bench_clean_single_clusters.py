@@ -0,0 +1,45 @@
+"""Compare the two singleton removal methods of clusterDf.clean_single_clusters on a synthetic cluster table
+Run from the repository root: python -m benchmarks.bench_clean_single_clusters --rows 10000000"""
+from utilities.clusterDf import remove_single_clusters
+import pandas as pd
+import numpy as np
+import argparse
+import time
+
+def synthetic_cluster_df(rows, singleton_share = 0.2, seed = 1):
+    """Build a cluster table of roughly passim shape - most clusters of 2-10 rows, with a share of clusters
+    reduced to a single row (as they would be after a date or book filter)"""
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(2, 11, size = rows // 4)
+    sizes[rng.random(len(sizes)) < singleton_share] = 1
+    sizes = sizes[np.cumsum(sizes) <= rows]
+    cluster = np.repeat(np.arange(len(sizes)), sizes)
+    # Shuffle so that the rows of a cluster are not contiguous (as in the concatenated shards)
+    cluster = rng.permutation(cluster)
+    n = len(cluster)
+    return pd.DataFrame({"cluster": cluster,
+                         "seq": rng.integers(1, 5000, size = n),
+                         "begin": rng.integers(0, 3000, size = n),
+                         "end": rng.integers(3000, 6000, size = n),
+                         "book": rng.choice(["0845Maqrizi.Mawaciz", "0845Maqrizi.Muqaffa", "0660IbnCadim.BughyatTalab"], size = n)})
+
+def time_method(cl_df, method):
+    start = time.perf_counter()
+    out = remove_single_clusters(cl_df, method = method)
+    return out, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark clean_single_clusters methods")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    cl_df = synthetic_cluster_df(args.rows)
+    print("Rows: {}, clusters: {}".format(len(cl_df), cl_df["cluster"].nunique()))
+
+    mask_out, mask_time = time_method(cl_df, "mask")
+    print("mask: {:.2f}s".format(mask_time))
+    groupby_out, groupby_time = time_method(cl_df, "groupby")
+    print("groupby: {:.2f}s".format(groupby_time))
+
+    pd.testing.assert_frame_equal(mask_out, groupby_out)
+    print("Outputs identical ({} rows kept), speed up: {:.1f}x".format(len(mask_out), groupby_time / mask_time))
@@ -5,6 +5,7 @@ from matplotlib import patches
 import seaborn as sns
 import re
 import json
+from utilities.metaIndex import read_meta_index
 
 def graph_source_count(ms_citations_csv, png_out, source_name, total_milestones, summary_csv_out=None, bin_size = 5, period_map = None, lost_source_list = None, use_agreement = None):
     """period_map_example = [{"period_name": "Fatimid", "start": 350, "end": 580, colour: "green"}]"""
@@ -177,7 +178,7 @@ if __name__ == "__main__":
     print("Total ms in {}: {}".format(main_text, ms_count))
 
     metadata = "F:/Corpus Stats/2023/OpenITI_metadata_2023-1-8.csv"
-    meta = pd.read_csv(metadata, encoding='utf-8-sig', sep='\t')
+    meta = read_meta_index(metadata, ["book"])
     book_uris = meta["book"].to_list()
     author_uris = [book.split(".")[0] for book in book_uris]
 
@@ -1,6 +1,6 @@
 from utilities.clusterDf import clusterDf
 from py_kitab_diff import kitab_diff
-from utilities.openitiTexts import openitiTextMs, openitiCorpus
+from utilities.openitiTexts import openitiCorpus, openitiTextStore
 from measure_local_overlap.pair_comparison import pairComparison
 import pandas as pd
 import json
@@ -15,25 +15,38 @@ class multitextDiffMap():
     Produce a mapping json that will allow for the drawing of a viz showing overlaps and unique sources
     within the source set.
     Approach will only work fully if markdown headings are available, but can force a limit based on an ms boundary"""
-    def __init__ (self, meta_tsv, corpus_base_path, cluster_path=None, pairwise_dir=None, uri_text_paths=None):
-        """uri_text_paths: a dict mapping book URIs to specific absolute paths to a text - to allow us to drop in a custom annotated text (need to ensure that milestoning still matches the data being used)"""
+    def __init__ (self, meta_tsv, corpus_base_path, cluster_path=None, pairwise_dir=None, uri_text_paths=None, cache_dir=None, text_store_dir=None):
+        """uri_text_paths: a dict mapping book URIs to specific absolute paths to a text - to allow us to drop in a custom annotated text (need to ensure that milestoning still matches the data being used)
+        cache_dir: optional clusterCache directory - if given the filtered cluster data is reused between runs rather than reloaded
+        text_store_dir: optional openitiTextStore directory - if given texts are parsed once and then loaded (memory mapped) from the store"""
         if cluster_path == None and pairwise_dir == None:
             print("A cluster_path or pairwise_path must be given. If both are provided then clusters are used for grouping and pairwise for writing diffs")
             exit()
 
         self.cluster_path = cluster_path
+        self.cache_dir = cache_dir
+        self.text_store = None
+        if text_store_dir is not None:
+            self.text_store = openitiTextStore(text_store_dir)
+        self.base_cluster_obj = None
         self.pairwise_dir = pairwise_dir
         self.meta_tsv_path = meta_tsv
         
-        self.openiti_paths = openitiCorpus(meta_tsv, corpus_base_path, language="ara")
+        # The corpus is kept so that every stage of the pipeline fetches its texts from the same pool
+        self.openiti_corpus = openitiCorpus(meta_tsv, corpus_base_path, language="ara", text_store=self.text_store)
 
         self.recurse_log = 0
 
         if uri_text_paths is not None:
-            self.openiti_paths.reassign_paths(uri_text_paths)
-            self.openiti_paths = self.openiti_paths.path_dict
-        else:
-            self.openiti_paths = self.openiti_paths.path_dict
+            self.openiti_corpus.reassign_paths(uri_text_paths)
+        self.openiti_paths = self.openiti_corpus.path_dict
+
+    def load_cluster_view(self):
+        """Return a fresh, unfiltered view of the cluster data. The clusters are only loaded from disk the first time - each
+        view has its own filters, so the filtering done by one pipeline run does not affect the next"""
+        if self.base_cluster_obj is None:
+            self.base_cluster_obj = clusterDf(self.cluster_path, self.meta_tsv_path, cache_dir=self.cache_dir)
+        return self.base_cluster_obj.copy_view()
 
     # If we want to pull out all possible matches for the supplied ranges - we're going to need to recurse - with each new ms range fetched, its possible new clusters will emerge - should go until we exchaust and that will need to account for incomplete md
 
@@ -94,7 +107,7 @@ class multitextDiffMap():
             book = row["book"]
 
 
-            openiti_text = openitiTextMs(self.openiti_paths[book])
+            openiti_text = self.openiti_corpus.fetch_text(book)
             for ms_range in row["ms_ranges"]:
                 # print(f"Book: {book}, range start: {ms_range[0]}, range_end {ms_range[-1]}")
                 
@@ -289,8 +302,7 @@ class multitextDiffMap():
         print("Loading mARkdown text data")
         obj_dict = {}
         for uri in tqdm(uri_list):
-            uri_path = self.openiti_paths[uri]
-            obj_dict[uri] = openitiTextMs(uri_path)
+            obj_dict[uri] = self.openiti_corpus.fetch_text(uri)
         return obj_dict
 
     def create_unidir_pairs(self, uri_list):
@@ -458,9 +470,9 @@ class multitextDiffMap():
 
         else:
             # Otherwise build pairwise from the clusters
-            # Reload clusters - to be sure we've got everything
+            # Take a new unfiltered view of the clusters - to be sure we've got everything
             print("Populating map from cluster data")
-            self.cluster_obj = clusterDf(self.cluster_path, self.meta_tsv_path)
+            self.cluster_obj = self.load_cluster_view()
 
             # Loop through each combination uni-laterally - once a pair is done that's it - get all clusters for that pair and calculate diffs
             # When writing out pairs, we write that out bidirectionally - so we can capture all reuse for each for the map
@@ -519,14 +531,14 @@ class multitextDiffMap():
                 # The start offset tells us what data to exclude from first ms, end offset tells us what to exclude from end offset
                 # To get an offset into the section we need to calculate cumulative offsets and augment - for later ordering, need to store first ms in output
                 # Note - b/c we returned pairwise bi-dir data - we're calculating these diffs twice once for each direction - a little expensive
-                section_position = 0
                 pairwise_data = pairs_data[book]
                 
                 for ms in section_ms:
                                      
                     ms_data = pairwise_data[pairwise_data["seq"] == ms]
                     self.used_rows = pd.concat([self.used_rows, ms_data])
-                    ms_len = section["ms_offsets"][ms][1]
+                    # The cleaned length of the section's milestones before this one (from the text's prefix sums)
+                    section_position = openiti_obj_b1.ms_range_clean_len(first_ms, ms - 1)
                 
                     if ms == first_ms:
                         ms_data = ms_data[ms_data["end"] > start_offset]
@@ -562,8 +574,6 @@ class multitextDiffMap():
                                                  "book2": book_2,
                                                  "ms2": ms2,
                                                  "section2": ms_sections_map[book_2].get(ms2, "Section outside dict")})
-                        
-                    section_position += ms_len
         
         return diff_offsets
 
@@ -713,10 +723,14 @@ class multitextDiffMap():
         for section_data in self.internal_data[book]:
             if section_data["tag_text"] == section:
                 ms_offsets = section_data["ms_offsets"]
+                ms_nos = sorted(section_data["ms_nos"])
 
         char_total= list(ms_offsets.values())[0][0]
-        for key, offset in ms_offsets.items():
-            char_total += offset[1]
+        if len(ms_offsets) == 1:
+            return char_total + ms_offsets[ms_nos[0]][1]
+        # Whole milestones up to the last from the text's prefix sums, then the part of the last milestone in the section
+        char_total += self.openiti_corpus.fetch_text(book).ms_range_clean_len(ms_nos[0], ms_nos[-1] - 1)
+        char_total += ms_offsets[ms_nos[-1]][1]
         return char_total
 
     def build_mapping_dictionary(self, pairwise_df, group_data_by_section=True):
@@ -808,11 +822,11 @@ class multitextDiffMap():
         self.log = log
 
         if self.cluster_path is not None:
-            # As the pipeline run will shrink the data as it goes - initiate a new cluster_obj with the pipeline
-            self.cluster_obj = clusterDf(self.cluster_path, self.meta_tsv_path)
+            # As the pipeline run will shrink the data as it goes - take a new view of the clusters for the pipeline
+            self.cluster_obj = self.load_cluster_view()
             
             # On later runs we're checking ms over and over - need to clean out ms we've already checked
-            maintext = openitiTextMs(self.openiti_paths[base_uri])
+            maintext = self.openiti_corpus.fetch_text(base_uri)
             initial_df = self.clusters_for_sections(maintext, base_uri, start_ms, end_ms)
             self.recurse_all_clusters(initial_df, log=log, max_recursions=max_recursions)
         
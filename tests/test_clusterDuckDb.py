@@ -0,0 +1,75 @@
+"""Chained filters on clusterDuckDb: each filter view must read the previous view once, so the query plan grows
+linearly with the number of filters rather than doubling"""
+from utilities.clusterDuckDb import clusterDuckDb
+from utilities.clusterDf import clusterDf
+import pandas as pd
+import numpy as np
+import os
+
+def write_fixture(tmp_path, books = 12, clusters = 3000, seed = 1):
+    """A synthetic passim output (one parquet shard) and the matching metadata TSV"""
+    rng = np.random.default_rng(seed)
+    book_uris = ["{:04d}Author{}.Book{}".format(200 + 50 * idx, idx, idx) for idx in range(books)]
+    rows = []
+    for cluster in range(clusters):
+        size = int(rng.integers(2, 8))
+        for book_idx in rng.choice(books, size = size, replace = False):
+            begin = int(rng.integers(0, 5000))
+            rows.append({"uid": len(rows), "gid": cluster, "cluster": cluster, "size": size,
+                         "seq": int(rng.integers(1, 60)), "series": "{}Ver-ara1".format(book_uris[book_idx].replace(".", "")),
+                         "text": "", "begin": begin, "end": begin + int(rng.integers(20, 300))})
+    shard_dir = os.path.join(tmp_path, "clusters")
+    os.makedirs(shard_dir)
+    pd.DataFrame(rows).to_parquet(os.path.join(shard_dir, "part-00000.parquet"))
+    meta = pd.DataFrame({"id": [uri.replace(".", "") + "Ver" for uri in book_uris], "book": book_uris,
+                         "date": [int(uri[:4]) for uri in book_uris], "status": "pri", "language": "ara",
+                         "local_path": ["../data/{}.txt".format(uri) for uri in book_uris]})
+    meta_path = os.path.join(tmp_path, "meta.tsv")
+    meta.to_csv(meta_path, sep="\t", index=False)
+    return shard_dir, meta_path, book_uris
+
+def assert_same_rows(db, cluster_obj):
+    """The rows of the current duckdb view match the filtered clusterDf (rows are compared in uid order)"""
+    result = db.to_df()
+    expected = cluster_obj.cluster_df
+    columns = [column for column in expected.columns if column in result.columns]
+    result = result[columns].sort_values("uid").reset_index(drop=True)
+    expected = expected[columns].sort_values("uid").reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+def test_chained_filters(tmp_path):
+    """Seven chained filters and a removal - a plan that doubled with each filter runs out of memory by the 6th"""
+    shard_dir, meta_path, books = write_fixture(str(tmp_path))
+    db = clusterDuckDb(shard_dir, meta_path, memory_limit = "1GB")
+    cluster_obj = clusterDf(shard_dir, meta_path)
+
+    steps = [lambda o: o.filter_by_date_range(200, 700),
+             lambda o: o.filter_by_book_list(books[:1], exclude_listed_books=True),
+             lambda o: o.filter_by_date_range(250, 700),
+             lambda o: o.filter_by_author_list([book.split(".")[0] for book in books[2:8]]),
+             lambda o: o.filter_by_book_list(books[2:7]),
+             lambda o: o.filter_by_date_range(300, 700),
+             lambda o: o.filter_by_book_list(books[6:7], exclude_listed_books=True),
+             lambda o: o.remove_clusters_by_uri_ms(books[3], list(range(1, 30)))]
+    for apply_filter in steps:
+        apply_filter(db)
+        apply_filter(cluster_obj)
+        assert_same_rows(db, cluster_obj)
+    db.close()
+
+def test_empty_list_filters(tmp_path):
+    """Filtering on an empty list keeps every row (exclude) or none, as clusterDf does"""
+    shard_dir, meta_path, books = write_fixture(str(tmp_path), clusters = 200)
+    db = clusterDuckDb(shard_dir, meta_path)
+    cluster_obj = clusterDf(shard_dir, meta_path)
+
+    steps = [lambda o: o.filter_by_book_list([], exclude_listed_books=True),
+             lambda o: o.remove_clusters_by_uri_ms(books[0], []),
+             lambda o: o.filter_by_author_list([]),
+             lambda o: o.filter_by_book_list([])]
+    for apply_filter in steps:
+        apply_filter(db)
+        apply_filter(cluster_obj)
+        assert_same_rows(db, cluster_obj)
+    assert len(db.to_df()) == 0
+    db.close()
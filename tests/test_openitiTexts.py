@@ -0,0 +1,37 @@
+"""Cleaned milestone lengths of openitiTextMs: the lengths and their prefix sums are built together on the first lookup,
+and range totals match the milestones cleaned one by one"""
+from utilities.openitiTexts import openitiTextMs
+from openiti.helper.funcs import text_cleaner
+import os
+
+def write_fixture(tmp_path, ms_count = 12):
+    """A small OpenITI text with a heading and ms_count milestones of varying length"""
+    lines = ["######OpenITI#", "", "#META#Header#End#", "", "### | باب الأول"]
+    for ms_no in range(1, ms_count + 1):
+        lines.append("# " + " ".join(["كلمة{}".format(ms_no)] * (ms_no * 3)) + " ms{:03d}".format(ms_no))
+    file_path = os.path.join(tmp_path, "0001Author.Book-ara1.mARkdown")
+    with open(file_path, "w", encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    return file_path
+
+def test_range_lengths(tmp_path):
+    text_obj = openitiTextMs(write_fixture(str(tmp_path)))
+    expected = {ms_no: len(text_cleaner(text_obj.fetch_milestone(ms_no))) for ms_no in range(1, 13)}
+
+    assert text_obj.clean_len_prefix is None
+    assert text_obj.get_ms_len(5) == expected[5]
+    assert text_obj.clean_len_prefix is not None
+
+    for ms_start in range(1, 13):
+        for ms_end in range(ms_start, 13):
+            assert text_obj.ms_range_clean_len(ms_start, ms_end) == sum(expected[ms_no] for ms_no in range(ms_start, ms_end + 1))
+    assert text_obj.ms_range_clean_len(4, 3) == 0
+
+    ms_lens = text_obj.get_ms_range_len(2, 9)
+    assert ms_lens == {ms_no: [0, expected[ms_no]] for ms_no in range(2, 10)}
+
+def test_range_lengths_with_clean_map(tmp_path):
+    text_obj = openitiTextMs(write_fixture(str(tmp_path)))
+    without_map = [text_obj.ms_range_clean_len(1, ms_end) for ms_end in range(1, 13)]
+    text_obj.build_clean_map()
+    assert [text_obj.ms_range_clean_len(1, ms_end) for ms_end in range(1, 13)] == without_map
@@ -0,0 +1,189 @@
+import pyarrow.feather as feather
+import pyarrow as pa
+import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+import time
+
+class clusterCache():
+    """A local on-disk cache of filtered cluster dataframes. Each entry is stored as an uncompressed feather file
+    (so that it can be read back memory mapped) and is keyed by the parameters used to load it:
+    source path and modification time, metadata hash, date range, cluster cap, columns and drop_strings.
+    The index and dtypes of the stored dataframe are kept so that a cached load matches an uncached one.
+    Entries are evicted least recently used first once the cache grows beyond max_bytes"""
+    def __init__ (self, cache_dir, max_bytes = 20 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "cache_index.json")
+        # {path: {"size", "mtime", "hash"}} - a metadata file is only hashed again when its size or modification time changes
+        self.meta_hashes_path = os.path.join(cache_dir, "meta_hashes.json")
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.index = self.load_index()
+
+    def load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding='utf-8') as f:
+                return json.load(f)
+        else:
+            return {}
+
+    def write_index(self):
+        json_string = json.dumps(self.index, ensure_ascii=False, indent=2)
+        with open(self.index_path, "w", encoding='utf-8') as f:
+            f.write(json_string)
+
+    def source_mtime(self, path):
+        """Modification time of the cluster source - for a directory of shards take the latest modification
+        time of any file in it, as replacing a shard does not always update the directory itself"""
+        if os.path.isdir(path):
+            mtimes = [os.path.getmtime(path)]
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    mtimes.append(os.path.getmtime(os.path.join(root, name)))
+            return max(mtimes)
+        else:
+            return os.path.getmtime(path)
+
+    def file_hash(self, path):
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def meta_hash(self, meta_path):
+        """Hash of the metadata file, recorded against its size and modification time so that it is only
+        re-hashed when the file changes"""
+        path = os.path.abspath(meta_path)
+        size, mtime = os.path.getsize(path), os.path.getmtime(path)
+        meta_hashes = {}
+        if os.path.exists(self.meta_hashes_path):
+            with open(self.meta_hashes_path, encoding='utf-8') as f:
+                meta_hashes = json.load(f)
+        entry = meta_hashes.get(path)
+        if entry is None or entry["size"] != size or entry["mtime"] != mtime:
+            entry = {"size": size, "mtime": mtime, "hash": self.file_hash(path)}
+            meta_hashes[path] = entry
+            with open(self.meta_hashes_path, "w", encoding='utf-8') as f:
+                f.write(json.dumps(meta_hashes, ensure_ascii=False, indent=2))
+        return entry["hash"]
+
+    def make_params(self, cluster_path, meta_path, min_date, max_date, cluster_cap, columns, drop_strings):
+        """Build the dictionary of load parameters that identifies a cache entry"""
+        return {"cluster_path": os.path.abspath(cluster_path),
+                "cluster_mtime": self.source_mtime(cluster_path),
+                "meta_hash": self.meta_hash(meta_path),
+                "min_date": min_date,
+                "max_date": max_date,
+                "cluster_cap": cluster_cap,
+                "columns": sorted(columns),
+                "drop_strings": drop_strings}
+
+    def make_key(self, params):
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.feather")
+
+    def fetch(self, key):
+        """Return the cached dataframe for a key, or None if there is no (valid) entry"""
+        entry_path = self._entry_path(key)
+        if key not in self.index or not os.path.exists(entry_path):
+            return None
+        print("Loading clusters from cache: {}".format(entry_path))
+        cluster_df = feather.read_table(entry_path, memory_map=True).to_pandas()
+        # Arrow reads text columns back as string dtype - restore the dtypes the dataframe had when it was stored
+        dtypes = self.index[key].get("dtypes", {})
+        changed = {column: dtype for column, dtype in dtypes.items()
+                   if column in cluster_df.columns and str(cluster_df[column].dtype) != dtype}
+        if len(changed) > 0:
+            cluster_df = cluster_df.astype(changed)
+        self.index[key]["last_used"] = time.time()
+        self.write_index()
+        return cluster_df
+
+    def store(self, key, cluster_df, params):
+        """Write a dataframe to the cache and evict old entries if the cache is over its size limit"""
+        entry_path = self._entry_path(key)
+        print("Writing clusters to cache: {}".format(entry_path))
+        # The index is stored with the data - an uncached load keeps the row labels of each shard
+        feather.write_feather(pa.Table.from_pandas(cluster_df), entry_path, compression="uncompressed")
+        self.index[key] = {"params": params,
+                           "bytes": os.path.getsize(entry_path),
+                           "rows": len(cluster_df),
+                           "dtypes": {column: str(dtype) for column, dtype in cluster_df.dtypes.items()},
+                           "created": time.time(),
+                           "last_used": time.time()}
+        self.write_index()
+        self.evict(keep=[key])
+
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self.index.values())
+
+    def evict(self, max_bytes=None, keep=[]):
+        """Remove least recently used entries until the cache is within max_bytes (defaults to self.max_bytes)
+        keep: keys that should not be evicted (e.g. the entry that has just been written)"""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        candidates = sorted(self.index.keys(), key=lambda k: self.index[k]["last_used"])
+        for key in candidates:
+            if self.total_bytes() <= max_bytes:
+                break
+            if key in keep:
+                continue
+            print("Evicting cache entry: {}".format(key))
+            self.purge(key)
+
+    def purge(self, key=None):
+        """Remove a single entry, or every entry if no key is given"""
+        if key is None:
+            keys = list(self.index.keys())
+        else:
+            keys = [key]
+        for key in keys:
+            entry_path = self._entry_path(key)
+            if os.path.exists(entry_path):
+                os.remove(entry_path)
+            self.index.pop(key, None)
+        self.write_index()
+
+    def list_entries(self):
+        """Return a dataframe summarising the cache entries"""
+        entries = []
+        for key, entry in self.index.items():
+            row = {"key": key, "bytes": entry["bytes"], "rows": entry["rows"],
+                   "created": pd.to_datetime(entry["created"], unit="s"),
+                   "last_used": pd.to_datetime(entry["last_used"], unit="s")}
+            row.update(entry["params"])
+            entries.append(row)
+        return pd.DataFrame(entries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or purge a cluster cache")
+    parser.add_argument("cache_dir", help="Path to the cache directory")
+    parser.add_argument("action", choices=["inspect", "purge", "evict"], help="inspect: list the entries, purge: remove entries, evict: shrink the cache to --max-gb")
+    parser.add_argument("--key", default=None, help="Key of a single entry to purge (purges all entries if not given)")
+    parser.add_argument("--max-gb", type=float, default=None, help="Size limit used by evict")
+    args = parser.parse_args()
+
+    cache = clusterCache(args.cache_dir)
+    if args.action == "inspect":
+        entries = cache.list_entries()
+        if len(entries) == 0:
+            print("Cache is empty")
+        else:
+            print(entries.to_string(index=False))
+            print("Total size: {:.2f} GB".format(cache.total_bytes() / 1024**3))
+    elif args.action == "purge":
+        cache.purge(args.key)
+    elif args.action == "evict":
+        if args.max_gb is None:
+            cache.evict()
+        else:
+            cache.evict(max_bytes=args.max_gb * 1024**3)
@@ -1,23 +1,299 @@
-from utilities.load_all_cls import load_all_cls
+from utilities.load_all_cls import load_all_cls, MINIFIED_SCHEMA
+from utilities.clusterCache import clusterCache
+from utilities.metaIndex import read_meta_index
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 import pandas as pd
+import numpy as np
 import re
 import os
 
+def remove_single_clusters(cl_df, method = "mask"):
+    """Remove the rows of clusters that only have one row left in cl_df
+    method: 'mask' flags every row whose cluster id appears more than once (a single hashed pass over the column)
+            'groupby' is the original groupby().filter() approach - it calls a python function once per cluster and is kept for comparison
+    Both return the same rows in the same order"""
+    if method == "groupby":
+        return cl_df.groupby("cluster").filter(lambda x: len(x) > 1)
+    clusters = cl_df["cluster"]
+    # groupby drops rows without a cluster id - so do the same here
+    return cl_df[clusters.duplicated(keep=False) & clusters.notna()]
+
+def expand_ranges(starts, ends):
+    """Take arrays of [start, end) ranges and return one array of every position in those ranges"""
+    lengths = ends - starts
+    lengths = np.where(lengths > 0, lengths, 0)
+    total = lengths.sum()
+    if total == 0:
+        return np.array([], dtype=np.int64)
+    # For each output position, its range start plus its distance from the start of that range in the output
+    range_offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - range_offsets, lengths) + np.arange(total)
+
+def ms_bitmap(ms_values, n_ms = None):
+    """Return a boolean array indexed by milestone number that is True for every milestone in ms_values
+    n_ms: if given, the array covers at least milestones 0 to n_ms (so every milestone of a text can be indexed)"""
+    ms_values = np.asarray(ms_values, dtype=np.int64)
+    size = ms_values.max() + 1 if len(ms_values) > 0 else 0
+    if n_ms is not None:
+        size = max(size, n_ms + 1)
+    bitmap = np.zeros(size, dtype=bool)
+    bitmap[ms_values] = True
+    return bitmap
+
+def ms_input_to_list(ms, input_type = "range"):
+    """Turn the ms argument of return_cluster_df_for_uri_ms into a list of milestones
+    ms: a single milestone, a [start, end] range (input_type 'range') or a list of milestones (input_type 'list')"""
+    if type(ms) == list and input_type == "range":
+        if len(ms) == 2:
+            ms_list = list(range(ms[0], ms[1]+1))
+            print(ms_list)
+            return ms_list
+        elif len(ms) == 1:
+            return ms[:]
+        else:
+            print("Range specified but list is greater than two - for a range supply only start and end ms... treating input ms as list of ms")
+            input_type = "list"
+    if input_type == "list":
+        return ms[:]
+    return [ms]
+
 class clusterDf():
-    def __init__ (self, cluster_path, meta_path, min_date=0, max_date = 1500, cluster_cap = 500, drop_strings = True, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"]):
-        self.cluster_df = load_all_cls(cluster_path, meta_path, drop_strings=drop_strings, columns = columns, drop_dates=False, max_date = max_date, min_date=min_date, cluster_cap = cluster_cap)
-        if cluster_path.split(".")[-1] == "csv":
-            if len(pd.read_csv(cluster_path)) > len(self.cluster_df):
+    def __init__ (self, cluster_path, meta_path, min_date=0, max_date = 1500, cluster_cap = 500, drop_strings = True, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"], workers = None, cache_dir = None, cache_max_bytes = 20 * 1024**3, encode = False):
+        """workers: number of processes used by load_all_cls to read the cluster shards
+        cache_dir: if given, the filtered cluster data is stored in (and reused from) a clusterCache in this directory
+        encode: if True, store the URI columns as categoricals and downcast the integer columns (see encode_columns)"""
+        if cache_dir is not None:
+            cache = clusterCache(cache_dir, max_bytes = cache_max_bytes)
+            cache_params = cache.make_params(cluster_path, meta_path, min_date, max_date, cluster_cap, columns, drop_strings)
+            cache_key = cache.make_key(cache_params)
+            self.cluster_df = cache.fetch(cache_key)
+        else:
+            self.cluster_df = None
+
+        if self.cluster_df is None:
+            self.cluster_df = load_all_cls(cluster_path, meta_path, drop_strings=drop_strings, columns = columns, drop_dates=False, max_date = max_date, min_date=min_date, cluster_cap = cluster_cap, workers = workers)
+            # Minified csv/parquet/feather inputs record their unfiltered row count - if the date filter or cap
+            # dropped rows, some clusters can be left with a single row
+            if self.cluster_df.attrs.get("rows_read", 0) > len(self.cluster_df):
                 self.cluster_df = self.clean_single_clusters(self.cluster_df)
+            if cache_dir is not None:
+                cache.store(cache_key, self.cluster_df, cache_params)
+        if encode:
+            self.encode_columns(meta_path)
         self.print_aggregated_stats()
-        
 
-    def clean_single_clusters(self, cl_df):
+    def memory_report(self, df_in = None):
+        """Print and return the (deep) memory use of each column of the cluster data"""
+        if df_in is None:
+            df_in = self.cluster_df
+        memory = df_in.memory_usage(deep=True, index=False)
+        report = pd.DataFrame({"column": memory.index, "dtype": [str(df_in[col].dtype) for col in memory.index], "bytes": memory.values})
+        print(report.to_string(index=False))
+        print("Total: {:.1f} MB".format(report["bytes"].sum() / 1024**2))
+        return report
+
+    def uri_categories(self, meta_path):
+        """Build categorical dtypes for the URI columns from the OpenITI metadata - using the metadata rather than the
+        cluster data means every clusterDf (and every filtered copy) shares the same codes for the same URI"""
+        meta_df = read_meta_index(meta_path, ["id", "book"])
+        books = meta_df["book"].dropna().drop_duplicates().sort_values()
+        return {"book": pd.CategoricalDtype(books.to_list()),
+                "id": pd.CategoricalDtype(meta_df["id"].dropna().drop_duplicates().sort_values().to_list()),
+                "author": pd.CategoricalDtype(sorted(set(book.split(".")[0] for book in books)))}
+
+    def encode_columns(self, meta_path, int_columns = ["seq", "begin", "end", "size", "cluster"]):
+        """Reduce the memory footprint of cluster_df: book, id and author are converted to categoricals using the metadata URIs,
+        series (which has no metadata equivalent) to a categorical of its own values, and the integer columns are downcast to the
+        smallest integer type that holds their values"""
+        print("Memory use before encoding:")
+        before = self.memory_report()
+
+        encoded_df = self.cluster_df.copy()
+        categories = self.uri_categories(meta_path)
+        for col, dtype in categories.items():
+            if col in encoded_df.columns:
+                encoded_df[col] = encoded_df[col].astype(dtype)
+        if "series" in encoded_df.columns:
+            encoded_df["series"] = encoded_df["series"].astype("category")
+        for col in int_columns:
+            # Columns with missing values are floats and are left as they are
+            if col in encoded_df.columns and pd.api.types.is_integer_dtype(encoded_df[col]):
+                encoded_df[col] = pd.to_numeric(encoded_df[col], downcast="integer")
+        self.cluster_df = encoded_df
+
+        print("Memory use after encoding:")
+        after = self.memory_report()
+        print("Reduced from {:.1f} MB to {:.1f} MB".format(before["bytes"].sum() / 1024**2, after["bytes"].sum() / 1024**2))
+
+    @property
+    def cluster_df(self):
+        """The cluster data as seen through the current filters. The loaded data (the base table) is never modified by the
+        filters - they set a boolean mask over it and the filtered dataframe is only built when it is asked for"""
+        if self._mask is None:
+            return self._base_df
+        if self._view_df is None:
+            self._view_df = self._base_df[self._mask]
+        return self._view_df
+
+    @cluster_df.setter
+    def cluster_df(self, cluster_df):
+        # Assigning data replaces the base table - filters, saved views and lookup indexes are reset
+        self._base_df = cluster_df
+        self._mask = None
+        self._view_df = None
+        self._mask_stack = []
+        self._indexes = {}
+        self._coverage = {}
+
+    def _set_mask(self, mask):
+        self._mask = mask
+        self._view_df = None
+        self._coverage = {}
+
+    def _clean_mask(self, mask):
+        """Mask version of clean_single_clusters - unset the rows of clusters that only have one row left in the mask"""
+        print("Cleaning up the single clusters")
+        rows = np.flatnonzero(mask)
+        clusters = self._base_df["cluster"].iloc[rows]
+        keep = clusters.duplicated(keep=False).to_numpy() & clusters.notna().to_numpy()
+        mask[rows[~keep]] = False
+        return mask
+
+    def _apply_filter(self, filter_mask, clean = True):
+        """Combine a boolean mask over the base table with the current filters (and clean up single clusters)"""
+        filter_mask = np.array(filter_mask, dtype=bool)
+        if self._mask is not None:
+            filter_mask = filter_mask & self._mask
+        if clean:
+            filter_mask = self._clean_mask(filter_mask)
+        self._set_mask(filter_mask)
+
+    def push_view(self):
+        """Save the current filters so that they can be restored with pop_view - e.g. before a set of
+        filters that only apply to one run of a pipeline"""
+        if self._mask is None:
+            self._mask_stack.append(None)
+        else:
+            self._mask_stack.append(self._mask.copy())
+
+    def pop_view(self):
+        """Restore the filters saved by the last push_view"""
+        if len(self._mask_stack) == 0:
+            print("No saved view to restore - filters left as they are")
+            return
+        self._set_mask(self._mask_stack.pop())
+
+    def reset_view(self):
+        """Remove all filters - cluster_df is the full loaded data again"""
+        self._set_mask(None)
+
+    def copy_view(self):
+        """Return a new clusterDf that shares the loaded data (and lookup indexes) of this one, starting from a copy of
+        the current filters. Filters applied to the copy do not affect this object, so several pipeline runs can each
+        work on their own view of one loaded cluster table"""
+        view = clusterDf.__new__(clusterDf)
+        view._base_df = self._base_df
+        view._indexes = self._indexes
+        view._view_df = None
+        view._mask_stack = []
+        view._coverage = {}
+        if self._mask is None:
+            view._mask = None
+        else:
+            view._mask = self._mask.copy()
+        return view
+
+    def _build_book_seq_index(self):
+        """Sort the row positions of the base table once by (book, seq) and store CSR style offsets of where each book starts.
+        The rows of a book are then a slice and the rows for its milestones are found by binary search.
+        The indexes are built over the base table, so filtering never invalidates them"""
+        codes, books = pd.factorize(self._base_df["book"])
+        seq = self._base_df["seq"].to_numpy()
+        order = np.lexsort((seq, codes))
+        sorted_codes = codes[order]
+        self._indexes["book_seq"] = {"book_codes": {book: code for code, book in enumerate(books)},
+                                "order": order,
+                                "seq": seq[order],
+                                # Rows without a book (code -1) sort first and are left out of the offsets
+                                "book_offsets": np.searchsorted(sorted_codes, np.arange(len(books) + 1))}
+
+    def _build_cluster_index(self):
+        """Sort the row positions once by cluster so the rows of a set of clusters can be found by binary search"""
+        clusters = self._base_df["cluster"].to_numpy()
+        order = np.argsort(clusters, kind="stable")
+        self._indexes["cluster"] = {"order": order, "cluster": clusters[order]}
+
+    def _visible(self, positions):
+        """Limit base table positions to those that pass the current filters"""
+        if self._mask is None:
+            return positions
+        return positions[self._mask[positions]]
+
+    def _book_positions(self, uri, ms_list = None):
+        """Return the base table positions (in row order) of the rows for a book, optionally limited to a list of milestones"""
+        if "book_seq" not in self._indexes:
+            self._build_book_seq_index()
+        index = self._indexes["book_seq"]
+        code = index["book_codes"].get(uri)
+        if code is None:
+            return np.array([], dtype=np.int64)
+        start = index["book_offsets"][code]
+        end = index["book_offsets"][code+1]
+        if ms_list is None:
+            positions = index["order"][start:end]
+        else:
+            book_seq = index["seq"][start:end]
+            ms_values = np.unique(np.asarray(ms_list))
+            starts = np.searchsorted(book_seq, ms_values, side="left")
+            ends = np.searchsorted(book_seq, ms_values, side="right")
+            positions = index["order"][start + expand_ranges(starts, ends)]
+        return np.sort(self._visible(positions))
+
+    def _cluster_positions(self, clusters):
+        """Return the base table positions (in row order) of all rows belonging to a list of clusters"""
+        if "cluster" not in self._indexes:
+            self._build_cluster_index()
+        index = self._indexes["cluster"]
+        cluster_values = np.unique(np.asarray(clusters))
+        starts = np.searchsorted(index["cluster"], cluster_values, side="left")
+        ends = np.searchsorted(index["cluster"], cluster_values, side="right")
+        return np.sort(self._visible(index["order"][expand_ranges(starts, ends)]))
+
+
+    def ms_coverage(self, uri, weighted = False, n_ms = None):
+        """Return an array indexed by milestone number of which milestones of a book are aligned with anything in the
+        current view - a bool array, or if weighted the number of other books aligned with each milestone.
+        Coverage is computed once per book and cached until the filters change. Use it for membership tests
+        (coverage[ms]) and set algebra with other milestone bitmaps (see ms_bitmap) rather than list lookups
+        n_ms: pad the array so that every milestone of the text up to n_ms can be indexed"""
+        key = (uri, weighted)
+        if key not in self._coverage:
+            positions = self._book_positions(uri)
+            seq = self._base_df["seq"].to_numpy()[positions]
+            coverage = ms_bitmap(seq)
+            if weighted:
+                clusters = self._base_df["cluster"].to_numpy()
+                ms_clusters = pd.DataFrame({"seq": seq, "cluster": clusters[positions]}).drop_duplicates()
+                cluster_positions = self._cluster_positions(ms_clusters["cluster"])
+                reusers = pd.DataFrame({"cluster": clusters[cluster_positions], "book": self._base_df["book"].to_numpy()[cluster_positions]})
+                reusers = reusers[reusers["book"] != uri].drop_duplicates()
+                ms_books = pd.merge(ms_clusters, reusers, on="cluster")[["seq", "book"]].drop_duplicates()
+                coverage = np.bincount(ms_books["seq"].to_numpy(dtype=np.int64), minlength=len(coverage))
+            self._coverage[key] = coverage
+        coverage = self._coverage[key]
+        if n_ms is not None and len(coverage) < n_ms + 1:
+            coverage = np.concatenate([coverage, np.zeros(n_ms + 1 - len(coverage), dtype=coverage.dtype)])
+        return coverage
+
+    def clean_single_clusters(self, cl_df, method = "mask"):
         """Filtering steps leave lone clusters - e.g. cluster of size 2 with a text from 845 and post 845
           filtered by date 845 will be left with only one item in the cluster. This creates problems downstream
-          All filtering processes need to be passed to this function"""
+          All filtering processes need to be passed to this function
+          method: 'mask' (default) or 'groupby' - see remove_single_clusters"""
         print("Cleaning up the single clusters")
-        return cl_df.groupby("cluster").filter(lambda x: len(x) > 1)
+        return remove_single_clusters(cl_df, method = method)
         # new_cl_df = pd.DataFrame()
         # cluster_list = cl_df["cluster"].drop_duplicates().to_list()
         # for cluster in tqdm(cluster_list):
@@ -40,9 +316,19 @@ class clusterDf():
         rows of the cluster - it will need to be reduced to a single row for any aggregate stats on the cluster"""
         return self.cluster_df[self.cluster_df["size"] == self.cluster_df["size"].max()]
 
-    def fetch_top_reusers(self, uri, uri_field="book", by = "length", exclude_self_reuse = False, dir = "bi", csv_out=None):
+    def fetch_top_reusers(self, uri, uri_field="book", by = "length", exclude_self_reuse = False, dir = "bi", csv_out=None, combine = False):
+        """uri: a single URI, or a list of URIs to rank the reusers of each of them in one pass - the output then has a
+        focal_uri column and is sorted within each focal URI
+        combine: if uri is a list, treat all of the URIs as a single focal text (e.g. to rank reusers across an author's oeuvre)"""
         # Set up pre-requisites to be used by other funcs
         self.exclude_self_reuse = exclude_self_reuse
+
+        if type(uri) == list:
+            stats_df = self.calculate_reuse_stats_multi(uri, uri_field=uri_field, exclude_self_reuse=exclude_self_reuse, dir=dir, combine=combine)
+            stats_df = stats_df.sort_values(by=["focal_uri", by], ascending=[True, False])
+            if csv_out:
+                stats_df.to_csv(csv_out, index=False)
+            return stats_df
         
         # Find death date of author and determine whether to filter before or after
         if dir != "bi":
@@ -66,68 +352,118 @@ class clusterDf():
         
         return stats_df
 
+    def build_reuse_matrix(self, dir = "bi", exclude_self_reuse = False, out_dir = None):
+        """Build sparse book x book matrices of shared characters, instances, clusters and milestones for the current view
+        in one pass (see utilities.reuseMatrix). The top reusers of any book are then a row slice: matrix.top_reusers(uri)
+        If out_dir is given the matrices are saved there - reload them memory mapped with reuseMatrix.load_reuse_matrix"""
+        # scipy is only needed for the matrix - import here so that clusterDf can be used without it
+        from utilities.reuseMatrix import build_reuse_matrix
+        reuse_matrix = build_reuse_matrix(self.cluster_df, dir=dir, exclude_self_reuse=exclude_self_reuse)
+        if out_dir is not None:
+            reuse_matrix.save(out_dir)
+        return reuse_matrix
+
     # Use a URI to fetch a list of clusters
+    # Book lookups use the (book, seq) index - other uri fields fall back to a scan
     def fetch_clusters_by_uri(self, uri, uri_field = "book"):
+        if uri_field == "book":
+            return self._base_df["cluster"].iloc[self._book_positions(uri)].to_list()
         return self.cluster_df[self.cluster_df[uri_field] == uri]["cluster"].to_list()
     
     # Use a URI and a ms_list to fetch cluster list
     def fetch_clusters_by_uri_mslist(self, uri, ms_list, uri_field="book"):
+        if uri_field == "book":
+            return self._base_df["cluster"].iloc[self._book_positions(uri, ms_list)].to_list()
         filtered = self.cluster_df[self.cluster_df[uri_field] == uri]
         return filtered[filtered["seq"].isin(ms_list)]["cluster"].to_list()
 
     # Fetch list of unique milestones that are aligned for one text
     def fetch_ms_for_uri(self, uri, uri_field="book"):
+        if uri_field == "book":
+            return self._base_df["seq"].iloc[self._book_positions(uri)].drop_duplicates().to_list()
         return self.cluster_df[self.cluster_df[uri_field] == uri]["seq"].drop_duplicates().to_list()
 
     # Concatenate the uris in a cluster set
-    def calculate_reuse_stats(self, uri, uri_field="book", df_in = None):
-        cluster_list = self.fetch_clusters_by_uri(uri, uri_field=uri_field)        
-        
+    def calculate_reuse_stats(self, uri, uri_field="book", df_in = None, exclude_self_reuse = None):
+        """For every book that shares a cluster with uri: the total length of its aligned passages, the number of aligned
+        passages (instances), and the number of distinct clusters and milestones involved"""
+        stats_df = self.calculate_reuse_stats_multi([uri], uri_field=uri_field, df_in=df_in, exclude_self_reuse=exclude_self_reuse)
+        return stats_df.drop(columns=["focal_uri"])
+
+    def calculate_reuse_stats_multi(self, uris, uri_field="book", df_in = None, exclude_self_reuse = None, dir = "bi", combine = False):
+        """Calculate the reuse stats of calculate_reuse_stats for many focal URIs with one join and one groupby aggregation
+        Returns a df with the columns: focal_uri, uri, length, instances, clusters, milestones
+        dir: 'bi', 'anachron' (only reusers that died before the focal author) or 'chron' (only those that died after)
+        combine: treat all of the uris as a single focal text - focal_uri is then the uris joined with '|'"""
+        if exclude_self_reuse is None:
+            exclude_self_reuse = getattr(self, "exclude_self_reuse", False)
         if df_in is None:
             df_in = self.cluster_df
-        
-        df_in = df_in[df_in["cluster"].isin(cluster_list)]    
-        print(df_in)
-        if self.exclude_self_reuse:
-            
-            df_in["author"] = df_in["book"].str.split(".", expand=True)[0]
-            uri_author = uri.split(".")[0]
-            df_in = df_in[df_in["author"] != uri_author]
-        
-        uri_list = df_in["book"].drop_duplicates().to_list()
-        if uri in uri_list:
-            uri_list.remove(uri)
-        stat_dicts = []
-        for uri in uri_list:
-            uri_df = df_in[df_in["book"] == uri]
-            uri_df["length"] = uri_df["end"] - uri_df["begin"]
-            stat_dicts.append({"uri": uri, "length": uri_df["length"].sum(), "instances": len(uri_df)})
-        
-        return pd.DataFrame(stat_dicts)
 
-    # Function to apply a date filter to the df
+        # The clusters of each focal uri
+        if uri_field == "book":
+            positions = [self._book_positions(uri) for uri in uris]
+            focal_df = self._base_df.iloc[np.concatenate([np.array([], dtype=np.int64)] + positions)]
+        else:
+            focal_df = self.cluster_df[self.cluster_df[uri_field].isin(uris)]
+        focal_df = focal_df[[uri_field, "cluster"]].rename(columns={uri_field: "focal_uri"})
+        focal_df["focal_uri"] = focal_df["focal_uri"].astype(object)
+        if combine:
+            focal_df["focal_uri"] = "|".join(uris)
+        focal_df = focal_df.drop_duplicates()
+
+        # Every row that shares a cluster with a focal uri - paired with that focal uri
+        columns = ["book", "cluster", "seq", "begin", "end"]
+        if dir != "bi":
+            columns.append("date")
+        reuse_df = pd.merge(df_in[columns], focal_df, on="cluster", how="inner")
+        reuse_df["book"] = reuse_df["book"].astype(object)
+
+        # Remove the focal text(s) themselves
+        if combine:
+            reuse_df = reuse_df[~reuse_df["book"].isin(uris)]
+        else:
+            reuse_df = reuse_df[reuse_df["book"] != reuse_df["focal_uri"]]
+
+        if exclude_self_reuse:
+            if combine:
+                focal_authors = [uri.split(".")[0] for uri in uris]
+                reuse_df = reuse_df[~reuse_df["book"].str.split(".").str[0].isin(focal_authors)]
+            else:
+                reuse_df = reuse_df[reuse_df["book"].str.split(".").str[0] != reuse_df["focal_uri"].str.split(".").str[0]]
+
+        if dir != "bi":
+            focal_dates = reuse_df["focal_uri"].str.extract(r"(\d+)", expand=False).astype(int)
+            if dir == "anachron":
+                reuse_df = reuse_df[reuse_df["date"] < focal_dates]
+            elif dir == "chron":
+                reuse_df = reuse_df[reuse_df["date"] > focal_dates]
+
+        reuse_df = reuse_df.assign(length = reuse_df["end"] - reuse_df["begin"])
+        stats_df = reuse_df.groupby(["focal_uri", "book"], sort=False).agg(length=("length", "sum"),
+                                                                             instances=("length", "size"),
+                                                                             clusters=("cluster", "nunique"),
+                                                                             milestones=("seq", "nunique")).reset_index()
+        return stats_df.rename(columns={"book": "uri"})
+
+    # The filters below narrow the current view - use push_view/pop_view or copy_view to keep the unfiltered data available
     def filter_by_date_range(self, min_date = 0, max_date= 1500):
-        self.cluster_df = self.cluster_df[self.cluster_df["date"].le(max_date)]
-        self.cluster_df = self.cluster_df[self.cluster_df["date"].ge(min_date)]
-        self.cluster_df = self.clean_single_clusters(self.cluster_df)
+        date = self._base_df["date"]
+        self._apply_filter((date.le(max_date) & date.ge(min_date)).to_numpy())
 
     def filter_by_author_list(self, author_list):
         print("Filtering clusters by authors: {}".format(author_list))
-        author_df = self.cluster_df.copy()
-        author_df["author"] = author_df["book"].str.split(".", expand=True)[0]        
-        self.cluster_df = author_df[author_df["author"].isin(author_list)]
-        self.cluster_df = self.clean_single_clusters(self.cluster_df)
-        self.cluster_df.drop(columns=["author"])
+        author = self._base_df["book"].str.split(".", expand=True)[0]
+        self._apply_filter(author.isin(author_list).to_numpy())
     
     def filter_by_book_list(self, book_list, exclude_listed_books=False):
         """If exclude_listed_books is true - it will return the only rows that do not match the book list"""
         if exclude_listed_books:
             print("Filtering clusters to exclude books: {}".format(book_list))
-            self.cluster_df = self.cluster_df[~self.cluster_df["book"].isin(book_list)]
+            self._apply_filter(~self._base_df["book"].isin(book_list).to_numpy())
         else:
             print("Filtering clusters by books: {}".format(book_list))
-            self.cluster_df = self.cluster_df[self.cluster_df["book"].isin(book_list)]
-        self.cluster_df = self.clean_single_clusters(self.cluster_df)
+            self._apply_filter(self._base_df["book"].isin(book_list).to_numpy())
 
     def remove_clusters_by_uri_ms(self, primary_book, ms_list):
         """Remove all clusters from the internal df self.cluster_df associated with the
@@ -135,29 +471,48 @@ class clusterDf():
         Used for operations where you're binning clusters and only want to consider a set of
         clusters once"""
         clusters = self.fetch_clusters_by_uri_mslist(primary_book, ms_list)
-        self.cluster_df = self.cluster_df[~self.cluster_df["cluster"].isin(clusters)]
+        if len(clusters) == 0:
+            return
+        keep = np.ones(len(self._base_df), dtype=bool)
+        keep[self._cluster_positions(clusters)] = False
+        self._apply_filter(keep, clean=False)
 
     def return_cluster_df_for_uri_ms(self, primary_book, ms = None, input_type = "range"):
         # None type allows this function to be used to fetch all of the clusters for an entire text (rather than specified milestones)
         if ms == None:
             clusters = self.fetch_clusters_by_uri(primary_book)
         else:
-            if type(ms) == list and input_type == "range":
-                if len(ms) == 2:
-                    ms_list = list(range(ms[0], ms[1]+1))
-                    print(ms_list)
-                elif len(ms) == 1:
-                    ms_list = ms[:]
-                else:
-                    print("Range specified but list is greater than two - for a range supply only start and end ms... treating input ms as list of ms")
-                    input_type = "list"
-            if input_type == "list":
-                ms_list = ms[:]
-            else:
-                ms_list = [ms]
-                
-            clusters = self.fetch_clusters_by_uri_mslist(primary_book, ms_list)
-        return self.cluster_df[self.cluster_df["cluster"].isin(clusters)]
+            clusters = self.fetch_clusters_by_uri_mslist(primary_book, ms_input_to_list(ms, input_type))
+        return self._base_df.iloc[self._cluster_positions(clusters)]
+
+    def return_cluster_df_for_uri_ms_batch(self, keys, primary_book = None):
+        """Batch version of return_cluster_df_for_uri_ms - fetch the clusters for many milestones in one call
+        keys: a list of milestones (if primary_book is given) or a list of (book, ms) pairs
+        Returns a single dataframe with all of the rows of every cluster that aligns with each key, tagged with
+        the key in the columns query_book and query_ms. Rows are ordered by key (in the order given) and then by
+        their order in cluster_df - so filtering on one key gives the same rows as return_cluster_df_for_uri_ms"""
+        if primary_book is not None:
+            key_df = pd.DataFrame({"query_book": primary_book, "query_ms": list(keys)})
+        else:
+            key_df = pd.DataFrame(list(keys), columns=["query_book", "query_ms"])
+        key_df["query_id"] = np.arange(len(key_df))
+
+        # Rows of the queried books at the queried milestones - paired with the keys they match
+        positions = [np.array([], dtype=np.int64)]
+        for book, book_keys in key_df.groupby("query_book", sort=False):
+            positions.append(self._book_positions(book, book_keys["query_ms"]))
+        key_rows = self._base_df.iloc[np.concatenate(positions)][["book", "seq", "cluster"]]
+        key_clusters = pd.merge(key_df, key_rows, left_on=["query_book", "query_ms"], right_on=["book", "seq"], how="inner")
+        key_clusters = key_clusters[["query_id", "query_book", "query_ms", "cluster"]].drop_duplicates()
+
+        # All rows of the matched clusters, joined back to the keys
+        cluster_positions = self._cluster_positions(key_clusters["cluster"])
+        cluster_rows = self._base_df.iloc[cluster_positions].assign(row_position = cluster_positions)
+        batch_df = pd.merge(key_clusters, cluster_rows, on="cluster", how="inner")
+        batch_df = batch_df.drop_duplicates(subset=["query_id", "row_position"])
+        batch_df = batch_df.sort_values(by=["query_id", "row_position"]).drop(columns=["query_id", "row_position"])
+
+        return batch_df.reset_index(drop=True)
     
     def print_aggregated_stats(self, greater_than_measure = 100):
         # Perform calculations
@@ -178,6 +533,26 @@ class clusterDf():
         minified_csv = self.cluster_df[columns]
         minified_csv.to_csv(out_path)
 
+    def minified_table(self):
+        """Build the arrow table written by to_minified_parquet/to_minified_feather: the columns of MINIFIED_SCHEMA
+        (the metadata book and date already joined) with explicit integer types, sorted by book and seq"""
+        minified_df = self.cluster_df[MINIFIED_SCHEMA.names]
+        minified_df = minified_df.astype({"book": str, "id": str})
+        minified_df = minified_df.sort_values(by=["book", "seq"], kind="stable")
+        return pa.Table.from_pandas(minified_df, schema=MINIFIED_SCHEMA, preserve_index=False)
+
+    def to_minified_parquet(self, out_path, compression = "zstd", row_group_size = 1_000_000):
+        """Write the minified clusters as a single parquet file that load_all_cls reads directly (no metadata join).
+        Rows are sorted by book and seq so the row group statistics allow pruning on book, seq and date"""
+        table = self.minified_table()
+        sorting = [pq.SortingColumn(table.schema.get_field_index("book")), pq.SortingColumn(table.schema.get_field_index("seq"))]
+        pq.write_table(table, out_path, compression=compression, row_group_size=row_group_size, sorting_columns=sorting)
+
+    def to_minified_feather(self, out_path, compression = "uncompressed", chunksize = 1_000_000):
+        """Write the minified clusters as a feather file that load_all_cls reads directly (no metadata join).
+        Uncompressed by default so that it can be memory mapped - use 'lz4' or 'zstd' for a smaller file"""
+        feather.write_feather(self.minified_table(), out_path, compression=compression, chunksize=chunksize)
+
 if __name__ == "__main__":
     print(os.getcwd())
     clusters = "D:/Corpus Stats/2023/v8-clusters/out.parquet"
@@ -0,0 +1,248 @@
+from utilities.load_all_cls import list_cls_shards
+from utilities.clusterDf import ms_input_to_list
+import pandas as pd
+import duckdb
+import re
+import os
+
+class clusterDuckDb():
+    """Out-of-core version of clusterDf for corpus-scale cluster data. The parquet/json shards (or a minified csv) and the
+    OpenITI metadata are registered as DuckDB views rather than loaded into memory, and the filters and queries of clusterDf
+    are run as SQL - DuckDB spills to temp_dir when a query does not fit in memory_limit. Only query results are returned as
+    pandas dataframes. Rows within a result are ordered by cluster, book, seq, begin rather than by their order in the shards
+    Each filter adds a view on top of the current one (reading it once) - use push_view/pop_view/reset_view as with clusterDf"""
+    def __init__ (self, cluster_path, meta_path, min_date=0, max_date = 1500, cluster_cap = 500, drop_strings = True, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"], db_path = None, temp_dir = None, memory_limit = None, threads = None):
+        """db_path: DuckDB database file (None for an in-memory database - data still spills to temp_dir)
+        temp_dir: directory DuckDB uses to spill intermediate results
+        memory_limit: DuckDB memory limit, e.g. '8GB'
+        threads: number of DuckDB threads (defaults to all cores)"""
+        if db_path is None:
+            db_path = ":memory:"
+        self.con = duckdb.connect(db_path)
+        if temp_dir is not None:
+            self.con.execute("SET temp_directory = '{}'".format(temp_dir.replace("'", "''")))
+        if memory_limit is not None:
+            self.con.execute("SET memory_limit = '{}'".format(memory_limit))
+        if threads is not None:
+            self.con.execute("SET threads = {}".format(int(threads)))
+
+        self.register_meta(meta_path, min_date, max_date)
+        self.register_clusters(cluster_path, cluster_cap, columns, drop_strings)
+
+        self.view_count = 0
+        self.view_stack = []
+        self.current_view = "clusters_base"
+        if cluster_path.split(".")[-1] == "csv":
+            # Mirror clusterDf - the minified csv can have lost rows of a cluster to the date filter
+            self._add_view(self._clean_sql(self.current_view))
+        self.base_view = self.current_view
+
+        self.print_aggregated_stats()
+
+    def _quote(self, value):
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    def _path_list(self, paths):
+        return "[{}]".format(", ".join(self._quote(path) for path in paths))
+
+    def register_meta(self, meta_path, min_date=0, max_date=1500):
+        """Register the metadata TSV (already filtered by date) as the view meta"""
+        print("Registering metadata: {}".format(meta_path))
+        self.con.execute("""CREATE OR REPLACE VIEW meta AS
+                            SELECT id, book, date FROM read_csv({}, delim='\t', header=true)
+                            WHERE date >= {} AND date <= {}""".format(self._quote(meta_path), int(min_date), int(max_date)))
+
+    def register_clusters(self, cluster_path, cluster_cap = 500, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"], drop_strings = True):
+        """Register the cluster data joined to the metadata and filtered by cluster cap as the view clusters_base"""
+        columns = [col for col in columns if not (drop_strings and col == "text")]
+        if cluster_path.split(".")[-1] == "csv":
+            print("Registering minified clusters: {}".format(cluster_path))
+            source = "read_csv_auto({})".format(self._quote(cluster_path))
+            # The minified csv is written with the pandas index and already has an id column
+            source_columns = ", ".join(['c."{}"'.format(col) for col in ["cluster", "id", "seq", "begin", "end", "size"]])
+            id_sql = ""
+        else:
+            print("Registering all clusters below: " + str(cluster_cap))
+            shards = list_cls_shards(cluster_path)
+            parquet = [file_path for file_path, file_type in shards if file_type == "parquet"]
+            json = [file_path for file_path, file_type in shards if file_type == "json"]
+            sources = []
+            select_columns = ", ".join('"{}"'.format(col) for col in columns)
+            if len(parquet) > 0:
+                sources.append("SELECT {} FROM read_parquet({})".format(select_columns, self._path_list(parquet)))
+            if len(json) > 0:
+                sources.append("SELECT {} FROM read_json_auto({}, format='newline_delimited')".format(select_columns, self._path_list(json)))
+            if len(sources) == 0:
+                raise ValueError("No parquet or json shards found below: {}".format(cluster_path))
+            source = "({})".format(" UNION ALL ".join(sources))
+            source_columns = ", ".join('c."{}"'.format(col) for col in columns if col != "id")
+            id_sql = ", split_part(c.series, '-', 1) AS id"
+        if cluster_cap is None:
+            cap_sql = ""
+        else:
+            cap_sql = "WHERE c.size < {}".format(int(cluster_cap))
+
+        self.con.execute("""CREATE OR REPLACE VIEW clusters_source AS
+                            SELECT {}{} FROM {} AS c {}""".format(source_columns, id_sql, source, cap_sql))
+        self.con.execute("""CREATE OR REPLACE VIEW clusters_base AS
+                            SELECT c.*, m.book, m.date FROM clusters_source AS c
+                            INNER JOIN meta AS m ON c.id = m.id""")
+
+    def _clean_sql(self, view, where_sql = None):
+        """SQL for the rows of a view (optionally only those matching where_sql) whose cluster has more than one row.
+        The rows of each cluster are counted with a window so the view is read once - a view is expanded inline by
+        DuckDB, so reading it twice would double the plan with every filter stacked on it"""
+        where = "" if where_sql is None else " WHERE {}".format(where_sql)
+        return """SELECT * EXCLUDE (cluster_rows) FROM
+                  (SELECT *, count(*) OVER (PARTITION BY cluster) AS cluster_rows FROM {}{})
+                  WHERE cluster_rows > 1""".format(view, where)
+
+    def _add_view(self, sql):
+        """Create a new view from sql and make it the current view"""
+        self.view_count += 1
+        view = "clusters_view_{}".format(self.view_count)
+        self.con.execute("CREATE OR REPLACE TEMP VIEW {} AS {}".format(view, sql))
+        self.current_view = view
+
+    def _apply_filter(self, where_sql, clean = True):
+        """Narrow the current view to the rows matching where_sql, then remove the clusters left with a single row.
+        where_sql must not read the current view (use a registered table instead) - see _clean_sql"""
+        if clean:
+            print("Cleaning up the single clusters")
+            self._add_view(self._clean_sql(self.current_view, where_sql))
+        else:
+            self._add_view("SELECT * FROM {} WHERE {}".format(self.current_view, where_sql))
+
+    def _register_values(self, values, dtype = "string"):
+        """Register a list of values as a one column table (value) to filter against. The column is typed (dtype)
+        to match the column it is compared with - an empty list would otherwise be registered as a float column"""
+        self.view_count += 1
+        name = "filter_values_{}".format(self.view_count)
+        self.con.register(name, pd.DataFrame({"value": pd.Series(list(values), dtype = dtype)}))
+        return name
+
+    def push_view(self):
+        self.view_stack.append(self.current_view)
+
+    def pop_view(self):
+        self.current_view = self.view_stack.pop()
+
+    def reset_view(self):
+        self.view_stack = []
+        self.current_view = self.base_view
+
+    def query(self, sql):
+        """Run sql (use {view} for the current view) and return the result as a pandas dataframe"""
+        return self.con.execute(sql.format(view=self.current_view)).df()
+
+    def to_df(self):
+        """Load the current view into a pandas dataframe (only do this once the view has been filtered down)"""
+        return self.query("SELECT * FROM {view} ORDER BY cluster, book, seq, begin")
+
+    def count_books(self):
+        return self.con.execute("SELECT count(DISTINCT book) FROM {}".format(self.current_view)).fetchone()[0]
+
+    def count_clusters(self):
+        return self.con.execute("SELECT count(DISTINCT cluster) FROM {}".format(self.current_view)).fetchone()[0]
+
+    def fetch_max_cluster(self):
+        return self.query("SELECT * FROM {view} WHERE size = (SELECT max(size) FROM {view}) ORDER BY cluster, book, seq, begin")
+
+    def print_aggregated_stats(self, greater_than_measure = 100):
+        cluster_count, count_clusters_greater_than = self.con.execute("""SELECT count(DISTINCT cluster), count(DISTINCT cluster) FILTER (WHERE size > {})
+                                                                          FROM {}""".format(int(greater_than_measure), self.current_view)).fetchone()
+        print("Total number of clusters: {}".format(cluster_count))
+        print("Total number of clusters with a size greater than {} : {}".format(greater_than_measure, count_clusters_greater_than))
+        largest_cluster = self.con.execute("SELECT cluster, size FROM {} ORDER BY size DESC, cluster LIMIT 1".format(self.current_view)).fetchone()
+        if largest_cluster is not None:
+            print("Size of largest cluster (cluster {}): {}".format(largest_cluster[0], largest_cluster[1]))
+
+    # Filters - as in clusterDf each narrows the current view and removes the clusters left with a single row
+    def filter_by_date_range(self, min_date = 0, max_date= 1500):
+        self._apply_filter("date <= {} AND date >= {}".format(int(max_date), int(min_date)))
+
+    def filter_by_author_list(self, author_list):
+        print("Filtering clusters by authors: {}".format(author_list))
+        values = self._register_values(author_list)
+        self._apply_filter("split_part(book, '.', 1) IN (SELECT value FROM {})".format(values))
+
+    def filter_by_book_list(self, book_list, exclude_listed_books=False):
+        """If exclude_listed_books is true - it will return the only rows that do not match the book list"""
+        values = self._register_values(book_list)
+        if exclude_listed_books:
+            print("Filtering clusters to exclude books: {}".format(book_list))
+            self._apply_filter("book NOT IN (SELECT value FROM {})".format(values))
+        else:
+            print("Filtering clusters by books: {}".format(book_list))
+            self._apply_filter("book IN (SELECT value FROM {})".format(values))
+
+    def _uri_ms_sql(self, uri, ms_list = None, uri_field = "book"):
+        """SQL for the distinct clusters of uri (optionally only at the milestones in ms_list) in the current view"""
+        if uri_field not in ["book", "id", "series"]:
+            raise ValueError("Unsupported uri_field: {}".format(uri_field))
+        sql = "SELECT DISTINCT cluster FROM {} WHERE {} = {}".format(self.current_view, uri_field, self._quote(uri))
+        if ms_list is not None:
+            sql += " AND seq IN (SELECT value FROM {})".format(self._register_values([int(ms) for ms in ms_list], dtype = "int64"))
+        return sql
+
+    def remove_clusters_by_uri_ms(self, primary_book, ms_list):
+        """Remove all clusters associated with the primary_book and list of ms in that book from the current view.
+        The clusters to remove are stored in a temp table first, so the new view does not read the current view twice"""
+        self.view_count += 1
+        removed = "removed_clusters_{}".format(self.view_count)
+        self.con.execute("CREATE OR REPLACE TEMP TABLE {} AS {}".format(removed, self._uri_ms_sql(primary_book, ms_list)))
+        self._apply_filter("NOT EXISTS (SELECT 1 FROM {} AS r WHERE r.cluster = {}.cluster)".format(removed, self.current_view), clean = False)
+
+    def fetch_clusters_by_uri(self, uri, uri_field = "book"):
+        return [row[0] for row in self.con.execute(self._uri_ms_sql(uri, uri_field = uri_field) + " ORDER BY cluster").fetchall()]
+
+    def fetch_clusters_by_uri_mslist(self, uri, ms_list, uri_field="book"):
+        return [row[0] for row in self.con.execute(self._uri_ms_sql(uri, ms_list, uri_field = uri_field) + " ORDER BY cluster").fetchall()]
+
+    def fetch_ms_for_uri(self, uri, uri_field="book"):
+        if uri_field not in ["book", "id", "series"]:
+            raise ValueError("Unsupported uri_field: {}".format(uri_field))
+        return self.query("SELECT DISTINCT seq FROM {{view}} WHERE {} = {} ORDER BY seq".format(uri_field, self._quote(uri)))["seq"].to_list()
+
+    def return_cluster_df_for_uri_ms(self, primary_book, ms = None, input_type = "range"):
+        # None type allows this function to be used to fetch all of the clusters for an entire text (rather than specified milestones)
+        if ms == None:
+            clusters_sql = self._uri_ms_sql(primary_book)
+        else:
+            clusters_sql = self._uri_ms_sql(primary_book, ms_input_to_list(ms, input_type))
+        return self.query("SELECT * FROM {{view}} WHERE cluster IN ({}) ORDER BY cluster, book, seq, begin".format(clusters_sql))
+
+    def calculate_reuse_stats(self, uri, uri_field="book", exclude_self_reuse = False, dir = "bi"):
+        """For every book that shares a cluster with uri: the total length of its aligned passages, the number of aligned
+        passages (instances), and the number of distinct clusters and milestones involved - see clusterDf.calculate_reuse_stats"""
+        where = ["r.book != {}".format(self._quote(uri))]
+        if exclude_self_reuse:
+            where.append("split_part(r.book, '.', 1) != {}".format(self._quote(uri.split(".")[0])))
+        if dir != "bi":
+            uri_death_date = int(re.findall(r"\d+", uri)[0])
+            if dir == "anachron":
+                where.append("r.date < {}".format(uri_death_date))
+            elif dir == "chron":
+                where.append("r.date > {}".format(uri_death_date))
+        return self.query("""SELECT r.book AS uri, sum(r."end" - r.begin) AS length, count(*) AS instances,
+                                    count(DISTINCT r.cluster) AS clusters, count(DISTINCT r.seq) AS milestones
+                             FROM {{view}} AS r WHERE r.cluster IN ({}) AND {}
+                             GROUP BY r.book""".format(self._uri_ms_sql(uri, uri_field = uri_field), " AND ".join(where)))
+
+    def fetch_top_reusers(self, uri, uri_field="book", by = "length", exclude_self_reuse = False, dir = "bi", csv_out=None):
+        stats_df = self.calculate_reuse_stats(uri, uri_field=uri_field, exclude_self_reuse=exclude_self_reuse, dir=dir)
+        stats_df = stats_df.sort_values(by=[by, "uri"], ascending=[False, True]).reset_index(drop=True)
+        if csv_out:
+            stats_df.to_csv(csv_out, index=False)
+        return stats_df
+
+    def close(self):
+        self.con.close()
+
+
+if __name__ == "__main__":
+    print(os.getcwd())
+    clusters = "D:/Corpus Stats/2023/v8-clusters/out.parquet"
+    meta = "D:/Corpus Stats/2023/OpenITI_metadata_2023-1-8.csv"
+    cluster_db = clusterDuckDb(clusters, meta, max_date = 1000, cluster_cap = 500, temp_dir = "D:/duckdb_tmp", memory_limit = "8GB")
+    print(cluster_db.fetch_top_reusers("0845Maqrizi.Mawaciz").head(20))
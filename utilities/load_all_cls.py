@@ -5,81 +5,268 @@ Created on Fri May 27 14:38:58 2022
 @author: mathe
 """
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 import os
+import time
+from multiprocessing import Pool
 from tqdm import tqdm
+from utilities.metaIndex import read_meta_index
+
+# Column types of the minified parquet/feather exports written by clusterDf.to_minified_parquet/to_minified_feather
+MINIFIED_SCHEMA = pa.schema([("cluster", pa.int64()),
+                             ("id", pa.string()),
+                             ("book", pa.string()),
+                             ("date", pa.int32()),
+                             ("seq", pa.int32()),
+                             ("begin", pa.int32()),
+                             ("end", pa.int32()),
+                             ("size", pa.int32())],
+                            metadata={"minified_clusters": "1"})
+
+# Column types of the minified csv written by clusterDf.to_minified_csv - only these columns are read
+MINIFIED_CSV_DTYPES = {"cluster": "int64", "id": str, "seq": "int32", "begin": "int32", "end": "int32", "size": "int32"}
+
+# Metadata used by the pool workers - set once per worker by _init_shard_worker so it is not pickled for every shard
+_worker_meta_df = None
+
+def list_cls_shards(path):
+    """Walk a passim cluster output directory and return a list of (file_path, file_type) for every
+    parquet or json shard. Checksum files are ignored and any other file type is reported and skipped"""
+    shards = []
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            file_type = None
+            split_name = name.split(".")
+            if split_name[-1] == "crc":
+                continue
+            if split_name[-1] == "parquet":
+                file_type = "parquet"
+            if split_name[-1] == "json":
+                file_type = "json"
+            if file_type == None:
+                print("Unrecognised file format. File name: {} ... skipping to next file".format(name))
+                continue
+            shards.append((os.path.join(root, name), file_type))
+    # Sort so that the output order does not depend on the file system or on the order in which workers finish
+    shards.sort()
+    return shards
+
+def filter_meta(meta_df, min_date=1, max_date=900):
+    """Apply the date filter to the metadata before it is joined to the clusters - the inner join
+    then drops every cluster row outside of the date range without a separate pass over the clusters"""
+    meta_df = meta_df[meta_df["date"].ge(min_date)]
+    meta_df = meta_df[meta_df["date"].le(max_date)]
+    return meta_df
+
+def filter_cls_shard(data, meta_df, cluster_cap = 500, drop_dates = True):
+    """Take the rows read from a single shard and apply the cluster cap, the series -> id split
+    and the (date filtered) metadata join"""
+    if cluster_cap is not None:
+        data = data[data["size"] < cluster_cap]
+
+    if "id" not in data.columns:
+        data = data.assign(id = data["series"].str.split("-").str[0])
+    data = pd.merge(data, meta_df, how = "inner", on ="id")
+
+    if drop_dates:
+        data = data.drop(columns = ["date"])
+
+    return data
+
+def cls_columns(columns, drop_strings = False):
+    """Return a copy of the columns to read from the shards, with the columns needed for filtering added
+    and the text column added or removed according to drop_strings"""
+    columns = list(columns)
+    if "size" not in columns:
+        columns.append("size")
+    if "series" not in columns:
+        columns.append("series")
+    if drop_strings:
+        if "text" in columns:
+            columns.remove("text")
+    else:
+        if "text" not in columns:
+            columns.append("text")
+    return columns
+
+def read_parquet_shard(file_path, meta_df, columns, cluster_cap = 500):
+    """Read a parquet shard as a pyarrow dataset so that only the requested columns are decoded and
+    the size filter is applied during the scan. The series -> id split and the date filter (ids missing from
+    the date filtered meta_df) are also applied in Arrow, so only the rows that are kept are converted to pandas"""
+    if cluster_cap is not None:
+        scan_filter = ds.field("size") < cluster_cap
+    else:
+        scan_filter = None
+    table = ds.dataset(file_path, format="parquet").to_table(columns=columns, filter=scan_filter)
+
+    ids = pc.list_element(pc.split_pattern(table["series"], "-"), 0)
+    table = table.append_column("id", ids)
+    table = table.filter(pc.is_in(ids, value_set=pa.array(meta_df["id"].astype(str))))
+
+    return table.to_pandas()
+
+def read_cls_shard(file_path, file_type, meta_df, columns, cluster_cap = 500, drop_dates = True):
+    """Read and filter a single shard. Returns the filtered data and a timing dict for the shard"""
+    start = time.perf_counter()
+    if file_type == "json":
+        data = pd.read_json(file_path, lines=True)[columns]
+        rows_read = len(data)
+    else:
+        rows_read = pq.read_metadata(file_path).num_rows
+        data = read_parquet_shard(file_path, meta_df, columns, cluster_cap = cluster_cap)
+
+    data = filter_cls_shard(data, meta_df, cluster_cap = cluster_cap, drop_dates = drop_dates)
+    timing = {"file": file_path, "rows_read": rows_read, "rows_kept": len(data), "seconds": time.perf_counter() - start}
+    return data, timing
+
+def _init_shard_worker(meta_df):
+    global _worker_meta_df
+    _worker_meta_df = meta_df
+
+def _read_cls_shard_worker(args):
+    file_path, file_type, columns, cluster_cap, drop_dates = args
+    return read_cls_shard(file_path, file_type, _worker_meta_df, columns, cluster_cap = cluster_cap, drop_dates = drop_dates)
+
+def iter_cls_shards(path, meta_df, cluster_cap = 500, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"], drop_strings = False, drop_dates = True, workers = None, timings = None):
+    """Generator that reads the shards of a passim cluster output and yields each one already filtered.
+    meta_df should already have been passed through filter_meta.
+    If workers is greater than 1 the shards are read by a process pool - shards are still yielded in the order of
+    list_cls_shards so the output is the same as a serial read.
+    If a list is passed as timings, the timing dict for each shard is appended to it"""
+    columns = cls_columns(columns, drop_strings = drop_strings)
+    shards = list_cls_shards(path)
+
+    if workers is not None and workers > 1:
+        print("Reading {} shards using {} workers".format(len(shards), workers))
+        args = [(file_path, file_type, columns, cluster_cap, drop_dates) for file_path, file_type in shards]
+        with Pool(workers, initializer=_init_shard_worker, initargs=(meta_df,)) as p:
+            for data, timing in tqdm(p.imap(_read_cls_shard_worker, args), total=len(args)):
+                if timings is not None:
+                    timings.append(timing)
+                yield data
+    else:
+        for file_path, file_type in tqdm(shards):
+            data, timing = read_cls_shard(file_path, file_type, meta_df, columns, cluster_cap = cluster_cap, drop_dates = drop_dates)
+            if timings is not None:
+                timings.append(timing)
+            yield data
+
+def report_shard_timings(timings, top = 5):
+    """Print a summary of the per-shard timings collected by iter_cls_shards and return them as a dataframe"""
+    timings_df = pd.DataFrame(timings)
+    if len(timings_df) == 0:
+        return timings_df
+    print("Shards read: {}, total shard time: {:.2f}s, mean per shard: {:.3f}s".format(len(timings_df), timings_df["seconds"].sum(), timings_df["seconds"].mean()))
+    print("Slowest shards:")
+    print(timings_df.sort_values(by="seconds", ascending=False).head(top).to_string(index=False))
+    return timings_df
+
+def minified_format(path):
+    """Return 'parquet' or 'feather' if path is a single minified export file (metadata already joined), otherwise None.
+    Note a passim output directory is also named *.parquet - only files carrying the minified schema metadata match"""
+    if not os.path.isfile(path):
+        return None
+    ext = path.split(".")[-1]
+    if ext == "parquet":
+        schema = pq.read_schema(path)
+    elif ext == "feather":
+        # Only the schema is read - the record batches are not decoded
+        with pa.memory_map(path) as source:
+            schema = pa.ipc.open_file(source).schema
+    else:
+        return None
+    if schema.metadata is not None and schema.metadata.get(b"minified_clusters") == b"1":
+        return ext
+    return None
+
+def read_minified_cls(path, file_format, min_date=1, max_date = 900, cluster_cap = 500, drop_dates = True):
+    """Load a minified parquet/feather export. The date and size filters are applied during the scan (for parquet the
+    row group statistics let whole row groups be skipped) and no metadata join is needed.
+    The number of rows in the file before filtering is recorded in the attrs of the output (rows_read)"""
+    dataset = ds.dataset(path, format=file_format)
+    scan_filter = (ds.field("date") >= min_date) & (ds.field("date") <= max_date)
+    if cluster_cap is not None:
+        scan_filter = scan_filter & (ds.field("size") < cluster_cap)
+    all_cls = dataset.to_table(filter=scan_filter).to_pandas()
+    if drop_dates:
+        all_cls = all_cls.drop(columns = ["date"])
+    all_cls.attrs["rows_read"] = dataset.count_rows()
+    return all_cls
+
+def read_minified_csv(path, meta_df, cluster_cap = 500, chunksize = 1_000_000):
+    """Read a minified csv in chunks, applying the cluster cap and the (date filtered) metadata join to each chunk so
+    that only the kept rows are held in memory. Only the columns in MINIFIED_CSV_DTYPES are read, with those types.
+    The number of rows in the csv before filtering is recorded in the attrs of the output (rows_read)"""
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [col for col in MINIFIED_CSV_DTYPES if col in header]
+    dtypes = {col: MINIFIED_CSV_DTYPES[col] for col in usecols}
+
+    chunks = []
+    rows_read = 0
+    for chunk in tqdm(pd.read_csv(path, usecols=usecols, dtype=dtypes, chunksize=chunksize)):
+        rows_read += len(chunk)
+        if cluster_cap is not None:
+            chunk = chunk[chunk["size"] < cluster_cap]
+        chunks.append(pd.merge(chunk, meta_df, on="id"))
+
+    if len(chunks) == 0:
+        all_cls = pd.DataFrame(columns = usecols + ["book", "date"])
+    else:
+        all_cls = pd.concat(chunks, ignore_index=True)
+    all_cls.attrs["rows_read"] = rows_read
+    return all_cls
+
+def load_all_cls(path, meta_path, min_date=1, max_date = 900, cluster_cap = 500, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"], drop_strings = False, drop_dates = True, stream = False, workers = None, timing_csv = None):
+    """Load the passim clusters (either a directory of parquet/json shards, a minified csv or a minified parquet/feather export)
+    joined to the metadata and filtered by date and cluster size.
+    If stream, return a generator of filtered dataframes (one per shard) instead of building the full dataframe
+    workers: number of processes used to read the shards (None or 1 reads them serially)
+    timing_csv: if given (and not streaming), the per-shard timings are written to this csv"""
+
+    file_format = minified_format(path)
+    if file_format is not None:
+        print("Loading Minified Clusters ({})".format(file_format))
+        all_cls = read_minified_cls(path, file_format, min_date=min_date, max_date=max_date, cluster_cap=cluster_cap, drop_dates=drop_dates)
+        print("New cluster data loaded...")
+        if stream:
+            return iter([all_cls])
+        return all_cls
+
+    meta_df = read_meta_index(meta_path, ["id", "book", "date"])
+    meta_df = filter_meta(meta_df, min_date=min_date, max_date=max_date)
 
-def load_all_cls(path, meta_path, min_date=1, max_date = 900, cluster_cap = 500, columns = ["uid", "gid", "cluster", "size", "seq", "series", "text", "begin", "end"], drop_strings = False, drop_dates = True):
-    
-    meta_df = pd.read_csv(meta_path, sep="\t")[["id", "book", "date"]]
-    
     if path.split(".")[-1] == "csv":
         print("Loading Minified Clusters")
-        all_cls = pd.read_csv(path)
-        all_cls = pd.merge(all_cls, meta_df, on="id")
-        if cluster_cap is not None:
-            all_cls = all_cls[all_cls["size"] < cluster_cap]
-        all_cls = all_cls[all_cls["date"].ge(min_date)]
-        all_cls = all_cls[all_cls["date"].le(max_date)]
+        all_cls = read_minified_csv(path, meta_df, cluster_cap = cluster_cap)
+        if stream:
+            return iter([all_cls])
     else:
-        all_cls = pd.DataFrame()
-        if "size" not in columns:
-            columns.append("size")
-        if "series" not in columns:
-            columns.append("series")
         print("Loading all clusters below: " + str(cluster_cap))
         print(path)
-        
-        for root, dirs, files in os.walk(path, topdown=False):
-            for name in tqdm(files):
-                file_type = None
-                split_name = name.split(".")
-                if split_name[-1] == "crc":
-                    continue
-                if split_name[-1] == "parquet":
-                    file_type = "parquet"
-                if split_name[-1] == "json":
-                    file_type = "json"
-                if file_type == None:
-                    print("Unrecognised file format. File name: {} ... skipping to next file".format(name))
-                    continue  
-                if file_type == "parquet" or file_type == "json":
-                    file_path = os.path.join(root, name)
-                    if drop_strings:
-                        if "text" in columns:
-                            columns.remove("text")
-                    else:
-                        if "text" not in columns:
-                            columns.append("text")
-                    
-                            
-                    if file_type == "json":
-                        data = pd.read_json(file_path, lines=True)[columns]
-                    else:
-                        data = pq.read_table(file_path).to_pandas()[columns]
-
-                    if cluster_cap is not None:
-                        data = data[data["size"] < cluster_cap]
-
-                    data["id"] = data["series"].str.split("-").str[0]
-                    data = pd.merge(data, meta_df, how = "inner", on ="id") 
-                    # Applying the date filter to output                
-                    data = data[data["date"].le(max_date)]
-                    data = data[data["date"].ge(min_date)]
-                    
-                    if drop_dates:
-                        data= data.drop(columns = ["date"])
-
-                    all_cls = pd.concat([all_cls, data])
-        
-    
-
-    
+
+        if stream:
+            return iter_cls_shards(path, meta_df, cluster_cap = cluster_cap, columns = columns, drop_strings = drop_strings, drop_dates = drop_dates, workers = workers)
+
+        timings = []
+        shards = iter_cls_shards(path, meta_df, cluster_cap = cluster_cap, columns = columns, drop_strings = drop_strings, drop_dates = drop_dates, workers = workers, timings = timings)
+
+        # Assemble once at the end - concatenating inside the loop re-copies the accumulated data for every shard
+        shards = list(shards)
+        timings_df = report_shard_timings(timings)
+        if timing_csv is not None:
+            timings_df.to_csv(timing_csv, index=False)
+        if len(shards) == 0:
+            all_cls = pd.DataFrame()
+        else:
+            all_cls = pd.concat(shards)
 
 
     print("New cluster data loaded...")
-    
-    
-    
+
+
+
     return all_cls
 
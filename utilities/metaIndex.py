@@ -0,0 +1,35 @@
+import pandas as pd
+import os
+
+# The metadata columns used across the pipelines - read together the first time the metadata is used
+META_INDEX_COLUMNS = ["id", "book", "local_path", "status", "language", "date"]
+
+# {path: {"key": (size, mtime), "header": [...], "index": df}} - one entry per metadata file for the process
+_meta_index_cache = {}
+
+def meta_header(meta_path):
+    """Read only the header of the metadata TSV"""
+    return pd.read_csv(meta_path, sep="\t", encoding="utf-8-sig", nrows=0).columns.to_list()
+
+def read_meta_index(meta_path, columns=None):
+    """Return the columns of the OpenITI metadata TSV that the caller needs (default META_INDEX_COLUMNS).
+    The TSV is read once per process and kept in memory - a header-only probe decides which columns are read and later
+    calls that need other columns only read those. The index is re-read if the file changes (size or modification time).
+    Columns that are not in the TSV are left out of the returned df. A byte order mark at the start of the file is ignored"""
+    path = os.path.abspath(meta_path)
+    key = (os.path.getsize(path), os.path.getmtime(path))
+    entry = _meta_index_cache.get(path)
+    if entry is None or entry["key"] != key:
+        header = meta_header(path)
+        usecols = [column for column in META_INDEX_COLUMNS if column in header]
+        entry = {"key": key, "header": header, "index": pd.read_csv(path, sep="\t", encoding="utf-8-sig", usecols=usecols)[usecols]}
+        _meta_index_cache[path] = entry
+
+    if columns is None:
+        columns = META_INDEX_COLUMNS
+    columns = [column for column in columns if column in entry["header"]]
+    missing = [column for column in columns if column not in entry["index"].columns]
+    if len(missing) > 0:
+        extra = pd.read_csv(path, sep="\t", encoding="utf-8-sig", usecols=missing)
+        entry["index"] = pd.concat([entry["index"], extra[missing]], axis=1)
+    return entry["index"][columns]
@@ -1,37 +1,400 @@
 from openiti.helper.funcs import read_text, text_cleaner
+from openiti.helper.ara import normalize_ara_light, transcription_chars
+from utilities.metaIndex import read_meta_index
+from collections import OrderedDict
+from collections.abc import Mapping
+from functools import lru_cache
+import unicodedata
+import numpy as np
+import hashlib
+import weakref
+import mmap
+import json
 import re
 import os
 import pandas as pd
+from tqdm import tqdm
+
+# The substitution text_cleaner applies after normalize_ara_light - non-word characters, digits and latin letters to a space
+CLEAN_SUB_PATTERN = re.compile(r"\W|\d|[" + transcription_chars + "]")
+
+@lru_cache(maxsize=None)
+def length_changing_chars():
+    """Boolean lookup table over the basic multilingual plane of the characters whose length normalize_ara_light can
+    change: characters that NFKC expands or that can combine with the character before them"""
+    table = np.zeros(0x10000, dtype=bool)
+    for code in range(0x10000):
+        if 0xD800 <= code <= 0xDFFF:
+            continue
+        char = chr(code)
+        if unicodedata.combining(char) != 0 or len(unicodedata.normalize("NFKC", char)) != 1:
+            table[code] = True
+    # Hamza - normalize_ara_light replaces ya + hamza and alif maqsura + hamza with a hamza
+    table[ord("ء")] = True
+    return table
+
+def text_codes(text):
+    """The code points of a string as a numpy array (one element per character)"""
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+def token_bounds(spaces, length, start=0, end=-1, padding=0, trim=0):
+    """Apply the padding and trim of openitiTextMs.fetch_offset_clean to a start and end offset, using the sorted
+    positions of the spaces in the cleaned text (spaces) rather than stepping through the text a character at a time.
+    A padded start moves back to the nearest space before it (or 0) and a padded end forward to the nearest space after it.
+    Returns start, end - to be used as text[start:end]"""
+    def snap_back(pos):
+        if pos <= 0:
+            return pos
+        if pos > length:
+            raise IndexError("string index out of range")
+        idx = int(np.searchsorted(spaces, pos, side="left")) - 1
+        return int(spaces[idx]) if idx >= 0 else 0
+
+    def snap_forward(pos):
+        if pos >= length:
+            return pos
+        idx = int(np.searchsorted(spaces, pos, side="right"))
+        if idx == len(spaces):
+            raise IndexError("string index out of range")
+        return int(spaces[idx])
+
+    if padding != 0:
+        if end != -1:
+            end = snap_forward(end + padding)
+        if start != 0:
+            start = snap_back(start - padding)
+    if trim != 0:
+        start = snap_back(start + trim)
+    return start, end
+
+def clean_offset_map(raw_text):
+    """Clean raw_text as text_cleaner does and map raw offsets to cleaned offsets
+    Returns the cleaned text and an array of len(raw_text)+1 where raw_to_clean[i] is the length of the cleaned
+    text of raw_text[:i] - so a raw position maps to the cleaned position of the first character kept from it onwards.
+    normalize_ara_light only changes lengths within a token, so those tokens are mapped character by character and
+    the rest of the text one to one. The space collapse of text_cleaner is applied with a numpy mask"""
+    normalized = normalize_ara_light(raw_text)
+
+    # Length of the normalized text of each raw prefix
+    norm_prefix = np.arange(len(raw_text) + 1, dtype=np.int64)
+    codes = text_codes(raw_text)
+    table = length_changing_chars()
+    # Characters outside the lookup table are treated as length changing
+    changing = np.ones(len(codes), dtype=bool)
+    in_table = codes < len(table)
+    changing[in_table] = table[codes[in_table]]
+    if changing.any():
+        # Expand each length changing character to the whitespace delimited token around it
+        space_positions = np.flatnonzero(np.isin(codes, [9, 10, 13, 32]))
+        changing_positions = np.flatnonzero(changing)
+        token_idx = np.unique(np.searchsorted(space_positions, changing_positions))
+        bounds = np.concatenate([[-1], space_positions, [len(codes)]])
+        token_starts = bounds[token_idx] + 1
+        token_ends = bounds[token_idx + 1]
+        # Normalize all of the candidate tokens in one call - only those whose length changes need mapping
+        tokens = [raw_text[start:end] for start, end in zip(token_starts, token_ends)]
+        normalized_tokens = normalize_ara_light("\n".join(tokens)).split("\n")
+        if len(normalized_tokens) != len(tokens):
+            normalized_tokens = [normalize_ara_light(token) for token in tokens]
+        shift = 0
+        last = 0
+        for start, end, token, normalized_token in zip(token_starts, token_ends, tokens, normalized_tokens):
+            if len(token) == len(normalized_token):
+                continue
+            token_lens = [len(normalize_ara_light(raw_text[start:pos])) for pos in range(start, end + 1)]
+            norm_prefix[last:start+1] += shift
+            norm_prefix[start:end+1] = start + shift + np.array(token_lens)
+            shift += token_lens[-1] - (end - start)
+            last = end + 1
+        norm_prefix[last:] += shift
+    if norm_prefix[-1] != len(normalized):
+        # Fall back to spreading the difference evenly - should not happen with the current normalisation
+        norm_prefix = np.round(np.arange(len(raw_text) + 1) * len(normalized) / max(len(raw_text), 1)).astype(np.int64)
+
+    # Collapse runs of spaces - a space is dropped if the character before it is also a space
+    substituted = CLEAN_SUB_PATTERN.sub(" ", normalized)
+    is_space = text_codes(substituted) == 32
+    keep = np.ones(len(is_space), dtype=bool)
+    keep[1:] = ~(is_space[1:] & is_space[:-1])
+    kept_prefix = np.concatenate([[0], np.cumsum(keep)])
+    clean_text = re.sub(" +", " ", substituted)
+
+    return clean_text, kept_prefix[norm_prefix]
+
+class cleanTextMap():
+    """Cleaned copy of a whole book with a raw -> cleaned offset map for each milestone.
+    clean_text is every milestone cleaned (with the same cleaning used for passim) and concatenated - clean_starts and
+    clean_ends give each milestone's slice. raw_to_clean holds the map of every milestone one after the other:
+    raw_to_clean[map_starts[i] + j] is the cleaned offset (within the milestone) of raw offset j of milestone i.
+    Positions i are positions in the milestone index of openitiTextMs (ms_numbers)"""
+    def __init__ (self, clean_text, clean_starts, clean_ends, map_starts, raw_to_clean):
+        self.clean_text = clean_text
+        self.clean_starts = clean_starts
+        self.clean_ends = clean_ends
+        self.map_starts = map_starts
+        self.raw_to_clean = raw_to_clean
+        self.spaces = None
+
+    @classmethod
+    def build(cls, ms_texts):
+        """Build the map from the raw text of each milestone (in milestone index order)"""
+        clean_texts = []
+        maps = []
+        for ms_text in ms_texts:
+            clean_text, raw_to_clean = clean_offset_map(ms_text)
+            clean_texts.append(clean_text)
+            maps.append(raw_to_clean)
+        clean_lens = np.array([len(text) for text in clean_texts], dtype=np.int64)
+        clean_ends = np.cumsum(clean_lens)
+        map_lens = np.array([len(raw_map) for raw_map in maps], dtype=np.int64)
+        map_starts = np.concatenate([[0], np.cumsum(map_lens)]).astype(np.int64)
+        # Offsets are within a milestone, so the smallest integer type that holds the longest milestone is enough
+        dtype = np.uint16 if clean_lens.max(initial=0) < 2**16 else np.uint32
+        raw_to_clean = np.concatenate(maps).astype(dtype) if len(maps) > 0 else np.array([], dtype=dtype)
+        return cls("".join(clean_texts), clean_ends - clean_lens, clean_ends, map_starts, raw_to_clean)
+
+    def ms_map(self, idx):
+        """The raw -> cleaned offset map of the milestone at position idx"""
+        return self.raw_to_clean[self.map_starts[idx]:self.map_starts[idx+1]]
+
+    def fetch_clean(self, idx):
+        return self.clean_text[self.clean_starts[idx]:self.clean_ends[idx]]
+
+    def ms_spaces(self, idx):
+        """Positions of the spaces in the cleaned milestone at position idx (the space positions of the whole cleaned
+        book are found once, on first use - or per milestone if the cleaned book is not held in memory)"""
+        if not isinstance(self.clean_text, str):
+            return np.flatnonzero(text_codes(self.fetch_clean(idx)) == ord(" "))
+        if self.spaces is None:
+            self.spaces = np.flatnonzero(text_codes(self.clean_text) == ord(" "))
+        ms_start = self.clean_starts[idx]
+        lo, hi = np.searchsorted(self.spaces, [ms_start, self.clean_ends[idx]])
+        return self.spaces[lo:hi] - ms_start
+
+    def save(self, out_path, source_key):
+        """Write the map as a sidecar .npz file. source_key identifies the text version it was built from"""
+        np.savez(out_path,
+                 clean_text=np.frombuffer(self.clean_text.encode("utf-8"), dtype=np.uint8),
+                 clean_starts=self.clean_starts,
+                 clean_ends=self.clean_ends,
+                 map_starts=self.map_starts,
+                 raw_to_clean=self.raw_to_clean,
+                 source_key=np.array(json.dumps(source_key)))
+
+    @classmethod
+    def load(cls, in_path, source_key):
+        """Load a sidecar written by save - returns None if it was built from a different version of the text"""
+        with np.load(in_path) as data:
+            if json.loads(str(data["source_key"])) != source_key:
+                return None
+            return cls(data["clean_text"].tobytes().decode("utf-8"), data["clean_starts"], data["clean_ends"],
+                       data["map_starts"], data["raw_to_clean"])
+
+class mmapText():
+    """Read-only, str-like view of a text stored as UTF-8 in a file. The file is memory mapped and a sparse index of
+    character offsets (char_offsets) and their byte offsets (byte_offsets) - e.g. the milestone boundaries - is used to
+    find the bytes of a slice, so only the blocks of the index that a slice covers are decoded.
+    The file is opened on first use and can be closed (close, or use as a context manager) - it is reopened if the text
+    is used again"""
+    def __init__ (self, file_path, char_offsets, byte_offsets):
+        self.file_path = file_path
+        self.char_offsets = char_offsets
+        self.byte_offsets = byte_offsets
+        self.length = int(char_offsets[-1])
+        self.file = None
+        self.buffer = None
+
+    def open(self):
+        if self.buffer is None:
+            self.file = open(self.file_path, "rb")
+            if os.path.getsize(self.file_path) > 0:
+                self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = b""
+        return self.buffer
+
+    def close(self):
+        if self.buffer is not None and not isinstance(self.buffer, bytes):
+            self.buffer.close()
+        if self.file is not None:
+            self.file.close()
+        self.buffer = None
+        self.file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return str(self)[key]
+            if stop <= start:
+                return ""
+            # The indexed blocks that hold [start, stop)
+            first = int(np.searchsorted(self.char_offsets, start, side="right")) - 1
+            last = int(np.searchsorted(self.char_offsets, stop, side="left"))
+            buffer = self.open()
+            text = buffer[int(self.byte_offsets[first]):int(self.byte_offsets[last])].decode("utf-8")
+            block_start = int(self.char_offsets[first])
+            return text[start - block_start:stop - block_start]
+        idx = int(key)
+        if idx < 0:
+            idx += self.length
+        if idx < 0 or idx >= self.length:
+            raise IndexError("string index out of range")
+        return self[idx:idx+1]
+
+    def __str__(self):
+        return self[:]
+
+class lazyCleanText():
+    """Read-only, str-like view of a cleaned book that is not held in memory: the cleaned text of a milestone is
+    produced (with text_cleaner, from the raw milestone text) when a slice needs it, and the most recently used
+    milestones are kept in an LRU cache of up to cache_max_chars characters"""
+    def __init__ (self, raw_text, ms_text_starts, ms_text_ends, clean_starts, clean_ends, cache_max_chars=20_000_000):
+        self.raw_text = raw_text
+        self.ms_text_starts = ms_text_starts
+        self.ms_text_ends = ms_text_ends
+        self.clean_starts = clean_starts
+        self.clean_ends = clean_ends
+        self.length = int(clean_ends[-1]) if len(clean_ends) > 0 else 0
+        self.cache = OrderedDict()
+        self.cache_chars = 0
+        self.cache_max_chars = cache_max_chars
+
+    def fetch_ms(self, idx):
+        """The cleaned text of the milestone at position idx"""
+        if idx in self.cache:
+            self.cache.move_to_end(idx)
+            return self.cache[idx]
+        text = text_cleaner(self.raw_text[int(self.ms_text_starts[idx]):int(self.ms_text_ends[idx])])
+        if len(text) <= self.cache_max_chars:
+            self.cache[idx] = text
+            self.cache_chars += len(text)
+            while self.cache_chars > self.cache_max_chars:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_chars -= len(evicted)
+        return text
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            idx = int(key)
+            if idx < 0:
+                idx += self.length
+            if idx < 0 or idx >= self.length:
+                raise IndexError("string index out of range")
+            return self[idx:idx+1]
+        start, stop, step = key.indices(self.length)
+        if step != 1:
+            return str(self)[key]
+        if stop <= start:
+            return ""
+        parts = []
+        idx = int(np.searchsorted(self.clean_ends, start, side="right"))
+        while idx < len(self.clean_ends) and self.clean_starts[idx] < stop:
+            ms_start = int(self.clean_starts[idx])
+            parts.append(self.fetch_ms(idx)[max(start - ms_start, 0):stop - ms_start])
+            idx += 1
+        return "".join(parts)
+
+    def __str__(self):
+        return "".join(self.fetch_ms(idx) for idx in range(len(self.clean_ends)))
+
+class msTextMap(Mapping):
+    """Read-only {ms_number: ms_text} mapping over a text. Only the offsets of each milestone are held - the text of a
+    milestone is sliced from the full text when it is requested, so no copy of the text is kept per milestone"""
+    def __init__ (self, text, ms_index, starts, ends):
+        self.text = text
+        self.ms_index = ms_index
+        self.starts = starts
+        self.ends = ends
+
+    def __getitem__(self, number):
+        idx = self.ms_index[number]
+        return self.text[self.starts[idx]:self.ends[idx]]
+
+    def __iter__(self):
+        return iter(self.ms_index)
+
+    def __len__(self):
+        return len(self.ms_index)
 
 class openitiTextMs():
     """A class for handling an OpenITI text as a group of milestones and applying various functions to it"""
-    def __init__ (self, file_path, report=False, pre_process_ms=True):
+    def __init__ (self, file_path, report=False, pre_process_ms=True, clean_cache_chars=20_000_000, text_store=None):
         """Read the text into the object using a file. Store the fulltext and store the milestone splits
         as a special type of dictionary:
         {22: "...كتابة..."}
-        On initiation, also create store maximum number of milestones in the text and the zfill level (for text mapping exercises)"""
+        On initiation, also create store maximum number of milestones in the text and the zfill level (for text mapping exercises)
+        clean_cache_chars: the maximum number of characters of cleaned milestone text kept in the LRU cache (0 disables it)
+        text_store: an openitiTextStore - if given the pre-parsed text is loaded (memory mapped) from the store, and the
+        store entry is built first if the text is not in the store or has changed since it was stored"""
         
-        # Initiate the ms_pattern to be used across the class
+        # Initiate the ms_pattern to be used across the class - patterns are compiled once per object
         self.ms_pattern = r"ms\d+"
+        self.regex_cache = {}
+        self.ms_regex = self.compile_regex(self.ms_pattern)
+
+        # LRU cache of cleaned milestones {ms_no: cleaned_text} and a cache of cleaned lengths {ms_no: len}
+        self.clean_cache = OrderedDict()
+        self.clean_cache_chars = 0
+        self.clean_cache_max_chars = clean_cache_chars
+        self.clean_len_cache = {}
+        self.cache_stats = {"clean_hits": 0, "clean_misses": 0, "len_hits": 0, "len_misses": 0}
 
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File {file_path} does not exist")
 
-        # Read in OpenITI text - split off header        
-        self.mARkdown_text = read_text(file_path, remove_header=True)
-        
-        # Run the init pipeline that populates the ms_dict
-        if pre_process_ms:
-            self.init_process_milestones()
-
         self.section_map = None
+        self.section_table = None
+        self.clean_map = None
+        self.clean_lens = None
+        self.clean_len_prefix = None
+
+        if text_store is not None:
+            text_store.load_text(self, file_path)
+        else:
+            # Read in OpenITI text - split off header        
+            self.mARkdown_text = read_text(file_path, remove_header=True)
+            
+            # Run the init pipeline that populates the ms_dict
+            if pre_process_ms:
+                self.init_process_milestones()
 
         if report:
             self.report_stats()
         
         self.file_path = file_path
-      
+
+    @property
+    def mARkdown_text(self):
+        """The text without its header. A text loaded from an openitiTextStore is memory mapped - it is only decoded
+        in full when a method needs the whole text (e.g. a regex over the full text)"""
+        if isinstance(self._mARkdown_text, mmapText):
+            self._mARkdown_text = str(self._mARkdown_text)
+        return self._mARkdown_text
+
+    @mARkdown_text.setter
+    def mARkdown_text(self, text):
+        self._mARkdown_text = text
     
+    def compile_regex(self, regex):
+        """Return the compiled regex, compiling each pattern only once for the object"""
+        if regex not in self.regex_cache:
+            self.regex_cache[regex] = re.compile(regex)
+        return self.regex_cache[regex]
+
     def report_stats(self):
         """Read out key stats if they are populated"""
         print(f"Text has a total of: {self.ms_total} milestones")
@@ -40,7 +403,7 @@ class openitiTextMs():
     def is_ms_marker(self, text):
         """Use the specified ms marker to identify if the text that is passed to the function is a ms marker"""
         
-        if len(re.findall(self.ms_pattern, text)) == 1:
+        if len(self.ms_regex.findall(text)) == 1:
             return True
         else:
             return False
@@ -53,61 +416,56 @@ class openitiTextMs():
             number = int(number)
         return number
 
-    def check_zfill(self, ms_splits):
-        """Take a text split into milestones and splits, find the first milestone marker and use that to calculate
+    def check_zfill(self, ms_markers):
+        """Take the milestone markers found in the text and use the first one to calculate
         the zfill (how long is the string used to represent the number)
         It also performs a check - if no ms is found through the whole text, an error is given. As we run this
         as part of the __init__ sequence it also checks the input text has valid formatting for this kind of
         processing"""
         
-        # Loop until we hit a valid milestone and use that to get the zfill
-        zfill = None
-        for ms_split in ms_splits:
-            if self.is_ms_marker(ms_split):
-                number = self.fetch_ms_number(ms_split, return_int=False)
-                zfill = len(number)
-                break
-        
         # Check that a valid ms has been found and return error if not - if found set the zfill variable
-        if zfill is not None:
-            self.zfill_len = zfill
+        if len(ms_markers) > 0:
+            self.zfill_len = len(self.fetch_ms_number(ms_markers[0], return_int=False))
         else:
-            print("ERROR: Text does not contain a valid milestone splitter, first 5 items split using the ms splitter:")
-            print(ms_splits[:5])
+            print("ERROR: Text does not contain a valid milestone splitter, start of the text:")
+            print(self.mARkdown_text[:200])
             exit()
 
-    def build_ms_dict(self, ms_splits):
-        """This is a reusable function - could be adapted to use different templates but for the moment the key is a
-        milestone as an integer and the value is the text of the milestone
-        Logic: if a split matches the ms marker, then the text preceding the milestone marker is the text for that milestone"""
-        
-        # Initiate ms_dict
-        ms_dict = {}
-
-        # Loop through the ms_splits, if the split is an ms tag, then take the previous list item as the corresponding text
-        for idx, ms_split in enumerate(ms_splits):
-            
-            if self.is_ms_marker(ms_split) and idx > 0:
-                ms_text = ms_splits[idx-1]
-                ms_int = self.fetch_ms_number(ms_split)
-                ms_dict[ms_int] = ms_text
-        
-        return ms_dict
-
-
     def init_process_milestones(self):
-        """Take an OpenITI text, initiate key stats about the milestones and populate a dictionary of milestones"""
+        """Take an OpenITI text, initiate key stats about the milestones and index the milestones
+        The text is scanned once for milestone markers and the number and [start, end) offsets of each milestone's text
+        (the text between the previous marker and its own marker) are stored in arrays. ms_dict is a mapping over
+        those offsets that slices the milestone text on request. If a milestone number is repeated the last one is used"""
         
-        # Wrap our milestone pattern in brackets so it is included within the splits
-        pattern= rf"({self.ms_pattern})"
-        ms_splits = re.split(pattern, self.mARkdown_text)
-
-        # Use the splits to get the zfill (and as part of that process check for error in input)
-        self.check_zfill(ms_splits)
+        ms_markers = []
+        marker_starts = []
+        marker_ends = []
+        for match in self.ms_regex.finditer(self.mARkdown_text):
+            ms_markers.append(match.group())
+            marker_starts.append(match.start())
+            marker_ends.append(match.end())
+
+        # Use the first marker to get the zfill (and as part of that process check for error in input)
+        self.check_zfill(ms_markers)
+
+        # Each milestone's text runs from the end of the previous marker to the start of its own marker
+        self.ms_numbers = np.array([self.fetch_ms_number(ms_marker) for ms_marker in ms_markers], dtype=np.int64)
+        self.ms_text_ends = np.array(marker_starts, dtype=np.int64)
+        self.ms_text_starts = np.array([0] + marker_ends[:-1], dtype=np.int64)
+
+        # Position of each milestone number in the arrays - later duplicates overwrite earlier ones
+        self.ms_index = {}
+        for idx, number in enumerate(self.ms_numbers.tolist()):
+            self.ms_index[number] = idx
 
         # Create the ms dictionary
-        self.ms_dict = self.build_ms_dict(ms_splits)
+        self.ms_dict = msTextMap(self.mARkdown_text, self.ms_index, self.ms_text_starts, self.ms_text_ends)
         self.ms_total = len(self.ms_dict)
+
+    def fetch_ms_span(self, number):
+        """Return the [start, end) character offsets of a milestone's text in mARkdown_text"""
+        idx = self.ms_index[int(number)]
+        return int(self.ms_text_starts[idx]), int(self.ms_text_ends[idx])
     
 
     def fetch_milestone(self, number, clean=False):
@@ -115,14 +473,118 @@ class openitiTextMs():
         OpenITI function (same that is used for passim cleaning - so offsets match)"""
         if type(number) == str:
             number = int(number)
-        text = self.ms_dict.get(number)
-        if clean and text is not None:
-            text = text_cleaner(text)
+        if clean:
+            text = self.fetch_clean_milestone(number)
+        else:
+            text = self.ms_dict.get(number)
         if text is None:
             print("Invalid ms given for text. Ms given: {number}")
             exit()
         return text
     
+    def fetch_clean_milestone(self, number):
+        """Return the cleaned text of a milestone (or None if it is not in the text) using the LRU cache of
+        cleaned milestones. The least recently used milestones are dropped once the cache holds more than
+        clean_cache_max_chars characters. If the cleaned book has been built (build_clean_map) it is sliced from that instead"""
+        if self.clean_map is not None:
+            idx = self.ms_index.get(number)
+            return None if idx is None else self.clean_map.fetch_clean(idx)
+
+        if number in self.clean_cache:
+            self.cache_stats["clean_hits"] += 1
+            self.clean_cache.move_to_end(number)
+            return self.clean_cache[number]
+
+        self.cache_stats["clean_misses"] += 1
+        text = self.ms_dict.get(number)
+        if text is None:
+            return None
+        text = text_cleaner(text)
+        self.clean_len_cache[number] = len(text)
+
+        # A milestone larger than the whole cache is not stored
+        if len(text) <= self.clean_cache_max_chars:
+            self.clean_cache[number] = text
+            self.clean_cache_chars += len(text)
+            while self.clean_cache_chars > self.clean_cache_max_chars:
+                _, evicted = self.clean_cache.popitem(last=False)
+                self.clean_cache_chars -= len(evicted)
+        return text
+
+    def clean_cache_info(self):
+        """Return the hit/miss counts and current size of the cleaned milestone caches"""
+        info = dict(self.cache_stats)
+        info.update({"cached_ms": len(self.clean_cache),
+                     "cached_chars": self.clean_cache_chars,
+                     "max_chars": self.clean_cache_max_chars,
+                     "cached_lens": len(self.clean_len_cache)})
+        return info
+
+    def resident_chars(self):
+        """Estimate of the characters of text the object holds in memory - used to budget pools of text objects.
+        Memory mapped text (from an openitiTextStore) is not counted until it is decoded"""
+        total = self.clean_cache_chars
+        if isinstance(self._mARkdown_text, str):
+            total += len(self._mARkdown_text)
+        if self.clean_map is not None:
+            if isinstance(self.clean_map.clean_text, str):
+                total += len(self.clean_map.clean_text)
+            elif isinstance(self.clean_map.clean_text, lazyCleanText):
+                total += self.clean_map.clean_text.cache_chars
+        return total
+
+    def close(self):
+        """Close the memory mapped file of a text loaded from an openitiTextStore (it is reopened if the text is used again)"""
+        if isinstance(getattr(self, "ms_dict", None), msTextMap) and isinstance(self.ms_dict.text, mmapText):
+            self.ms_dict.text.close()
+
+    def build_clean_map(self, sidecar_path=None):
+        """Build (once) a cleaned copy of the whole book and a raw -> cleaned offset map for every milestone (cleanTextMap).
+        Cleaned milestones are then sliced from the cleaned book and offsets are translated by array lookup.
+        sidecar_path: an .npz file to load the map from - if it is missing or was built from a different version of the
+        text (by size and modification time), the map is built and written there"""
+        source_key = {"path": os.path.abspath(self.file_path),
+                      "size": os.path.getsize(self.file_path),
+                      "mtime": os.path.getmtime(self.file_path)}
+        if sidecar_path is not None and os.path.exists(sidecar_path):
+            self.clean_map = cleanTextMap.load(sidecar_path, source_key)
+            if self.clean_map is not None:
+                self.build_clean_lens()
+                return self.clean_map
+
+        ms_texts = [self.mARkdown_text[start:end] for start, end in zip(self.ms_text_starts, self.ms_text_ends)]
+        self.clean_map = cleanTextMap.build(ms_texts)
+        self.build_clean_lens()
+        if sidecar_path is not None:
+            self.clean_map.save(sidecar_path, source_key)
+        return self.clean_map
+
+    def raw_to_clean_offset(self, ms_number, raw_offset):
+        """Translate a character offset into the raw milestone text into an offset into the cleaned milestone"""
+        if self.clean_map is None:
+            self.build_clean_map()
+        return int(self.clean_map.ms_map(self.ms_index[int(ms_number)])[raw_offset])
+
+    def clean_to_raw_offset(self, ms_number, clean_offset):
+        """Translate an offset into the cleaned milestone (e.g. a passim begin/end) into the raw milestone text -
+        the last raw position that maps to it, so the raw character of a kept cleaned character is returned"""
+        if self.clean_map is None:
+            self.build_clean_map()
+        raw_map = self.clean_map.ms_map(self.ms_index[int(ms_number)])
+        return int(np.searchsorted(raw_map, clean_offset, side="right")) - 1
+
+    def tag_offsets_clean(self, ms_number, tag="#{3} [|$][^\nms]+", regex=True):
+        """Return the offset in the cleaned milestone of the start of each match of a tag, using the offset map
+        (unlike calculate_tag_offset_clean, offsets are positions in the milestone cleaned as a whole)"""
+        if self.clean_map is None:
+            self.build_clean_map()
+        ms_number = int(ms_number)
+        raw_map = self.clean_map.ms_map(self.ms_index[ms_number])
+        ms_text = self.fetch_milestone(ms_number)
+        if not regex:
+            tag = re.escape(tag)
+        return [int(raw_map[match.start()]) for match in self.compile_regex(tag).finditer(ms_text)]
+
     def calculate_tag_offset_clean(self, ms_number, tag="#{3} [|$][^\nms]+", regex=True):
         """Use a specified tag or search term to calculate a cleaned offset
         Returns cleaned offsets for each place where tag is located"""
@@ -133,10 +595,11 @@ class openitiTextMs():
 
         # When looping splits, exclude the last split, so offsets mirror heading pos not length of last section
         if regex:
-            splits = re.split(tag, ms_text)
+            tag_regex = self.compile_regex(tag)
+            splits = tag_regex.split(ms_text)
             offset = 0
             for split in splits[:-1]:
-                if not re.match(tag, split):
+                if not tag_regex.match(split):
                     
                     offset += len(text_cleaner(split))
                     tag_offsets.append(offset)
@@ -165,42 +628,54 @@ class openitiTextMs():
         start = int(start)
         end = int(end)
 
+        # If the cleaned book is built, slice the span straight from it
+        if self.clean_map is not None and ms_number in self.ms_index:
+            span_start, span_end = self.clean_span(ms_number, start=start, end=end, padding=padding, trim=trim)
+            return self.clean_map.clean_text[span_start:span_end]
+
         # Fetch a cleaned version of the milestone text
         text = self.fetch_milestone(ms_number, clean=True)
-        
-
 
         # If adding padding - find end or start of nearest token to offset - to avoid word splitting
-        if padding != 0:
-                        
-            if end != -1:
-                ms_end = len(text)
-                end = end + padding
-                captured_text = None
-                while captured_text != " " and end < ms_end:
-                    end += 1
-                    captured_text = text[end]
-            if start != 0:
-                start = start - padding
-                captured_text = None
-                while captured_text != " " and start > 0:
-                    start -= 1
-                    captured_text = text[start]
-        
-        if trim != 0:
-            ms_end = len(text)
-            start = start + trim
-            captured_text = None
-            while captured_text != " " and start > 0:
-                start-= 1
-                captured_text = text[start]
-
+        if padding != 0 or trim != 0:
+            spaces = np.flatnonzero(text_codes(text) == ord(" "))
+            start, end = token_bounds(spaces, len(text), start=start, end=end, padding=padding, trim=trim)
         
         # Make offset
         text = text[start:end]
 
         return text
 
+    def clean_span(self, ms_number, start=0, end=-1, padding=0, trim=0):
+        """Return the (start, end) of a span of a cleaned milestone as offsets into the cleaned book (clean_map.clean_text),
+        with the same start, end, padding and trim as fetch_offset_clean"""
+        if self.clean_map is None:
+            self.build_clean_map()
+        idx = self.ms_index[int(ms_number)]
+        ms_start = int(self.clean_map.clean_starts[idx])
+        ms_len = int(self.clean_map.clean_ends[idx]) - ms_start
+        start, end = int(start), int(end)
+        if padding != 0 or trim != 0:
+            start, end = token_bounds(self.clean_map.ms_spaces(idx), ms_len, start=start, end=end, padding=padding, trim=trim)
+        # Resolve the offsets as the milestone text would be sliced
+        start, end, _ = slice(start, end).indices(ms_len)
+        return ms_start + start, ms_start + max(start, end)
+
+    def ms_list_spans(self, ms_list, start=0, end=-1, padding=0):
+        """Return the spans of the cleaned book that make up fetch_ms_list_clean(ms_list) - the start offset into the first
+        milestone, whole milestones, then the end offset into the last milestone - as a list of (start, end)"""
+        total_idx = len(ms_list) - 1
+        spans = []
+        for idx, ms_number in enumerate(ms_list):
+            if idx == 0:
+                spans.append(self.clean_span(ms_number, start=start, padding=padding))
+            elif idx == total_idx:
+                spans.append(self.clean_span(ms_number, end=end, padding=padding))
+            else:
+                ms_idx = self.ms_index[int(ms_number)]
+                spans.append((int(self.clean_map.clean_starts[ms_idx]), int(self.clean_map.clean_ends[ms_idx])))
+        return spans
+
     def _check_ms_regex(self, ms_no, regex, return_index=None):
         """Fetch the ms text, check if regex is in the milestone
         return_index: the index of the match to return, if None return all matches as a list
@@ -213,7 +688,7 @@ class openitiTextMs():
         if ms_text is None:
             return True, None
 
-        matches = re.findall(regex, ms_text)
+        matches = self.compile_regex(regex).findall(ms_text)
         if len(matches) == 0:
             match_status = False
             match = None
@@ -311,11 +786,50 @@ class openitiTextMs():
     #     return sections_list
     
     def get_ms_count(self):
-        last_ms = re.findall(self.ms_pattern, self.mARkdown_text)[-1]
+        # The number of the last milestone marker in the text - use the milestone index if it has been built
+        if hasattr(self, "ms_numbers"):
+            return int(self.ms_numbers[-1])
+        last_ms = self.ms_regex.findall(self.mARkdown_text)[-1]
         last_ms = self.fetch_ms_number(last_ms)
         return last_ms
     
+    def build_clean_lens(self):
+        """Compute the cleaned length of every milestone in one pass (clean_lens, in milestone index order) and their
+        prefix sums by milestone number (clean_len_prefix[n] is the total cleaned length of the milestones numbered
+        below n - a number missing from the text counts as 0). If the cleaned book is built the lengths are taken from
+        it, otherwise every milestone is cleaned once. Built on the first length lookup if not built with the map"""
+        if self.clean_map is not None:
+            self.clean_lens = (np.asarray(self.clean_map.clean_ends) - np.asarray(self.clean_map.clean_starts)).astype(np.int64)
+        else:
+            self.clean_lens = np.array([len(text_cleaner(self.mARkdown_text[start:end]))
+                                        for start, end in zip(self.ms_text_starts, self.ms_text_ends)], dtype=np.int64)
+        # A repeated milestone number takes the length of its last occurrence, as ms_index does
+        lens_by_no = np.zeros(int(np.max(self.ms_numbers, initial=0)) + 1, dtype=np.int64)
+        for ms_no, idx in self.ms_index.items():
+            lens_by_no[ms_no] = self.clean_lens[idx]
+        self.clean_len_prefix = np.concatenate([[0], np.cumsum(lens_by_no)]).astype(np.int64)
+        return self.clean_lens
+
+    def ms_range_clean_len(self, ms_start, ms_end):
+        """Total cleaned length of the milestones numbered ms_start to ms_end (inclusive) - 0 if ms_end < ms_start"""
+        if self.clean_len_prefix is None:
+            self.build_clean_lens()
+        last = len(self.clean_len_prefix) - 1
+        ms_start = min(max(int(ms_start), 0), last)
+        ms_end = min(max(int(ms_end) + 1, ms_start), last)
+        return int(self.clean_len_prefix[ms_end] - self.clean_len_prefix[ms_start])
+
     def get_ms_len(self, ms_no):
+        """Length of the cleaned milestone - the lengths of every milestone are computed together on the first call"""
+        ms_no = int(ms_no)
+        if self.clean_lens is None:
+            self.build_clean_lens()
+        if ms_no in self.ms_index:
+            return int(self.clean_lens[self.ms_index[ms_no]])
+        if ms_no in self.clean_len_cache:
+            self.cache_stats["len_hits"] += 1
+            return self.clean_len_cache[ms_no]
+        self.cache_stats["len_misses"] += 1
         return len(self.fetch_milestone(ms_no, clean=True))
 
     def get_clean_len(self, splits):
@@ -326,7 +840,7 @@ class openitiTextMs():
     def fetch_section_offset(self, ms_no, position, ms_head_regex = r"(#{3} [|$][^\nms]+)"):
         """position: 'first' or 'last' - if first take first section if last take last section"""
         # Get ms and split it on the regex - don't clean
-        splits = re.split(ms_head_regex, self.fetch_milestone(ms_no))
+        splits = self.compile_regex(ms_head_regex).split(self.fetch_milestone(ms_no))
         # Get the offset position
         # If the split doesn't work - we return the len of the ms if it's in the last pos and zero if first
         if len(splits) == 1:
@@ -362,11 +876,11 @@ class openitiTextMs():
         ms_lens[ms_end] = [0, offset_end]
 
         
-        # Handle the remaining ms
-        for i in range(ms_start+1, ms_end):
-            
-            ms_len = self.get_ms_len(i)
-            ms_lens[i] = [0, ms_len]
+        # Handle the remaining ms - their lengths are the differences of the prefix sums
+        if ms_end > ms_start + 1:
+            middle_lens = np.diff(self.clean_len_prefix[ms_start+1:ms_end+1]).tolist()
+            for i, ms_len in zip(range(ms_start+1, ms_end), middle_lens):
+                ms_lens[i] = [0, ms_len]
         
         return ms_lens
 
@@ -392,14 +906,43 @@ class openitiTextMs():
         
         return self.section_map.get(ms_no, ["None found"])[head_index], ms_list
 
+    def build_section_table(self, last_ms):
+        """Build a sorted table of the sections of the text from the section map, with the columns:
+        start_ms: the milestone holding the heading that opens the section (1 for the text before the first heading)
+        end_ms: the milestone holding the heading that closes it (last_ms + 1 for the last section)
+        heading: the opening heading ("None found" for the text before the first heading)
+        Sections share their boundary milestones, as a heading can fall anywhere in a milestone"""
+        self.ms_head_map()
+        start_ms = sorted(ms_no for ms_no in self.section_map if 1 <= ms_no <= last_ms)
+        headings = [self.section_map[ms_no][-1] for ms_no in start_ms]
+        if len(start_ms) == 0 or start_ms[0] != 1:
+            start_ms.insert(0, 1)
+            headings.insert(0, "None found")
+        start_ms = np.array(start_ms, dtype=np.int64)
+        end_ms = np.append(start_ms[1:], last_ms + 1)
+        self.section_table = {"start_ms": start_ms, "end_ms": end_ms, "heading": headings, "last_ms": last_ms}
+
     def retrieve_section_for_ms(self, ms_no, last_ms):
+        """Return the heading of the section that ms_no is in and the milestones from the section's opening heading up
+        to the next heading (or to last_ms + 1). The section is found with a binary search of the section table"""
 
         self.ms_head_map()
 
-        section_name, ms_list_before = self.find_nearest_section(ms_no, last_ms, "backwards")
-        section_name_after, ms_list_after = self.find_nearest_section(ms_no+1, last_ms, "forwards")
+        # Milestones outside of the text are left to the step by step search
+        if ms_no < 1 or ms_no > last_ms:
+            section_name, ms_list_before = self.find_nearest_section(ms_no, last_ms, "backwards")
+            section_name_after, ms_list_after = self.find_nearest_section(ms_no+1, last_ms, "forwards")
+            return section_name, list(set(ms_list_before + ms_list_after))
+
+        if self.section_table is None or self.section_table["last_ms"] != last_ms:
+            self.build_section_table(last_ms)
 
-        full_ms_list = list(set(ms_list_before + ms_list_after))
+        idx = int(np.searchsorted(self.section_table["start_ms"], ms_no, side="right")) - 1
+        section_name = self.section_table["heading"][idx]
+        start_ms = int(self.section_table["start_ms"][idx])
+        end_ms = int(self.section_table["end_ms"][idx])
+
+        full_ms_list = list(set(range(start_ms, end_ms + 1)))
 
         return section_name, full_ms_list 
 
@@ -432,7 +975,7 @@ class openitiTextMs():
 
         last_ms = self.get_ms_count()
 
-        found_ms = []
+        found_ms = set()
         sections_list = []
 
 
@@ -453,7 +996,7 @@ class openitiTextMs():
                 sections_list.append({"tag_text": section_name,
                                             "ms_nos": full_ms_list,
                                             "ms_offsets": ms_offsets})
-            found_ms.extend(full_ms_list)
+            found_ms.update(full_ms_list)
 
         return sections_list
 
@@ -463,32 +1006,45 @@ class openitiTextMs():
     def check_regex(self, regex, min_results=2):
         """See if a regex applied to the full text returns something to avoid endlessly querying for regex you won't find
         or splitting a text that's not fully annotated (has low result count)"""
-        results = re.findall(regex, self.mARkdown_text)
+        results = self.compile_regex(regex).findall(self.mARkdown_text)
         if len(results) > min_results:
             return True
         else:
             return False
 
     def ms_head_map(self, ms_head_regex = r"#{3} [|$][^\nms]+", overwrite=False):
-        """Produce a section map {ms_no: [head_1, head_2]}"""
+        """Produce a section map {ms_no: [head_1, head_2]}, where each heading is mapped to the first milestone
+        marker that follows it. The text is scanned once for headings and markers, and each heading offset is
+        matched to its marker with a binary search over the marker offsets"""
         if self.section_map is None or overwrite:
 
-            full_regex = fr"{ms_head_regex}|{self.ms_pattern}"
-           
-            results_list = re.findall(full_regex, self.mARkdown_text)
+            full_regex = self.compile_regex(fr"(?P<head>{ms_head_regex})|{self.ms_pattern}")
+
+            heads = []
+            head_offsets = []
+            ms_numbers = []
+            ms_offsets = []
+            for match in full_regex.finditer(self.mARkdown_text):
+                if match.start("head") != -1:
+                    heads.append(match.group())
+                    head_offsets.append(match.start())
+                else:
+                    ms_numbers.append(self.fetch_ms_number(match.group()))
+                    ms_offsets.append(match.start())
+
+            # Index of the first marker after each heading
+            head_ms_idx = np.searchsorted(np.array(ms_offsets, dtype=np.int64), np.array(head_offsets, dtype=np.int64))
+            if len(head_ms_idx) > 0 and head_ms_idx[-1] == len(ms_offsets):
+                raise IndexError("Heading found after the last milestone marker")
 
             self.section_map = {}
-
-            for idx, result in enumerate(results_list):
-                if re.match(ms_head_regex, result):
-                    ms_idx = idx
-                    while not re.match(self.ms_pattern, results_list[ms_idx]):                    
-                        ms_idx += 1
-                    ms_no = self.fetch_ms_number(results_list[ms_idx])
-                    if ms_no in self.section_map.keys():
-                        self.section_map[ms_no].append(result)
-                    else:
-                        self.section_map[ms_no] = [result] 
+            self.section_table = None
+            for head, ms_idx in zip(heads, head_ms_idx.tolist()):
+                ms_no = ms_numbers[ms_idx]
+                if ms_no in self.section_map:
+                    self.section_map[ms_no].append(head)
+                else:
+                    self.section_map[ms_no] = [head]
         
 
     def fetch_ms_list_clean(self, ms_list, start=0, end=-1, ms_joins=True, padding=0, trim=0):
@@ -496,6 +1052,25 @@ class openitiTextMs():
         and end is the offset into the last milestone
         ms_joins adds the milestone marker (according to the zfill of in input text) between the milestone boundaries. If set to false then
         the texts are joined without any indication of milestone boundaries"""
+        # If the cleaned book is built, slice the spans from it - adjacent spans are sliced as one
+        if self.clean_map is not None and all(int(ms_number) in self.ms_index for ms_number in ms_list):
+            spans = self.ms_list_spans(ms_list, start=start, end=end, padding=padding)
+            final_list = []
+            if ms_joins:
+                for idx, (span_start, span_end) in enumerate(spans):
+                    final_list.append(self.clean_map.clean_text[span_start:span_end])
+                    if idx != len(spans) - 1:
+                        final_list.append(f"ms{str(ms_list[idx]).zfill(self.zfill_len)}")
+            else:
+                merged = [list(spans[0])] if spans else []
+                for span_start, span_end in spans[1:]:
+                    if span_start == merged[-1][1]:
+                        merged[-1][1] = span_end
+                    else:
+                        merged.append([span_start, span_end])
+                final_list = [self.clean_map.clean_text[span_start:span_end] for span_start, span_end in merged]
+            return "".join(final_list)
+
         total_idx = len(ms_list) - 1
         final_list = []
         for idx, ms_number in enumerate(ms_list):
@@ -522,19 +1097,163 @@ class openitiTextMs():
         full_text = "".join(final_list)
         return full_text
 
+class openitiTextStore():
+    """On-disk store of pre-parsed OpenITI texts, so that each text is read, split and cleaned once rather than every
+    time an openitiTextMs is created. Each entry is a directory (named by a hash of the text path) holding:
+    the text without its header as UTF-8 with an index of the byte offset of every milestone boundary (so it can be
+    memory mapped and sliced by character offset), the milestone index, the cleaned milestone lengths and the raw -> clean
+    offset map as .npy files, and a json of the zfill, the heading map and the path, size and modification time of the
+    source - an entry is rebuilt if the source changes. The cleaned text is not stored - it is cleaned per milestone from
+    the raw text when it is used"""
+    # Entries written by an older layout are rebuilt
+    STORE_VERSION = 2
+
+    def __init__ (self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def entry_dir(self, file_path):
+        return os.path.join(self.store_dir, hashlib.sha1(os.path.abspath(file_path).encode("utf-8")).hexdigest())
+
+    def source_key(self, file_path):
+        return {"path": os.path.abspath(file_path),
+                "size": os.path.getsize(file_path),
+                "mtime": os.path.getmtime(file_path)}
+
+    def is_current(self, file_path):
+        """True if the store has an entry for the current version of the text"""
+        meta_path = os.path.join(self.entry_dir(file_path), "meta.json")
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        return meta.get("store_version") == self.STORE_VERSION and meta["source"] == self.source_key(file_path)
+
+    def build(self, file_path):
+        """Parse a text and write its store entry"""
+        text_obj = openitiTextMs(file_path)
+        clean_map = text_obj.build_clean_map()
+        try:
+            text_obj.ms_head_map()
+            section_map = {str(ms_no): heads for ms_no, heads in text_obj.section_map.items()}
+        except IndexError:
+            # A heading after the last milestone - leave the map to be built (and fail) as it would without the store
+            section_map = None
+
+        entry_dir = self.entry_dir(file_path)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+
+        # Write the text block by block (between milestone boundaries), recording the byte offset of each block
+        text = text_obj.mARkdown_text
+        char_offsets = np.unique(np.concatenate([[0, len(text)], text_obj.ms_text_starts, text_obj.ms_text_ends])).astype(np.int64)
+        byte_offsets = np.zeros(len(char_offsets), dtype=np.int64)
+        with open(os.path.join(entry_dir, "text.utf8"), "wb") as f:
+            for idx in range(len(char_offsets) - 1):
+                block = text[char_offsets[idx]:char_offsets[idx+1]].encode("utf-8")
+                f.write(block)
+                byte_offsets[idx+1] = byte_offsets[idx] + len(block)
+
+        arrays = {"char_offsets": char_offsets,
+                  "byte_offsets": byte_offsets,
+                  "ms_numbers": text_obj.ms_numbers,
+                  "ms_text_starts": text_obj.ms_text_starts,
+                  "ms_text_ends": text_obj.ms_text_ends,
+                  "clean_starts": clean_map.clean_starts,
+                  "clean_ends": clean_map.clean_ends,
+                  "map_starts": clean_map.map_starts,
+                  "raw_to_clean": clean_map.raw_to_clean}
+        for name, array in arrays.items():
+            np.save(os.path.join(entry_dir, f"{name}.npy"), array)
+        # The meta file is written last - an entry is only used once it is complete
+        meta = {"store_version": self.STORE_VERSION, "source": self.source_key(file_path), "zfill_len": text_obj.zfill_len, "section_map": section_map}
+        with open(os.path.join(entry_dir, "meta.json"), "w", encoding='utf-8') as f:
+            f.write(json.dumps(meta, ensure_ascii=False))
+
+    def build_all(self, file_paths):
+        """Build the entries for a list of texts, skipping those that are already current"""
+        for file_path in tqdm(file_paths):
+            if not self.is_current(file_path):
+                self.build(file_path)
+
+    def load_text(self, text_obj, file_path):
+        """Populate an openitiTextMs from the store (building the entry first if needed)"""
+        if not self.is_current(file_path):
+            self.build(file_path)
+        entry_dir = self.entry_dir(file_path)
+        with open(os.path.join(entry_dir, "meta.json"), encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in ["char_offsets", "byte_offsets", "ms_numbers", "ms_text_starts", "ms_text_ends", "clean_starts", "clean_ends", "map_starts", "raw_to_clean"]:
+            arrays[name] = np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="r")
+
+        raw_text = mmapText(os.path.join(entry_dir, "text.utf8"), arrays["char_offsets"], arrays["byte_offsets"])
+        text_obj.mARkdown_text = raw_text
+        text_obj.zfill_len = meta["zfill_len"]
+        text_obj.ms_numbers = arrays["ms_numbers"]
+        text_obj.ms_text_starts = arrays["ms_text_starts"]
+        text_obj.ms_text_ends = arrays["ms_text_ends"]
+        text_obj.ms_index = {}
+        for idx, number in enumerate(text_obj.ms_numbers.tolist()):
+            text_obj.ms_index[number] = idx
+        text_obj.ms_dict = msTextMap(raw_text, text_obj.ms_index, text_obj.ms_text_starts, text_obj.ms_text_ends)
+        text_obj.ms_total = len(text_obj.ms_dict)
+        if meta["section_map"] is not None:
+            text_obj.section_map = {int(ms_no): heads for ms_no, heads in meta["section_map"].items()}
+        clean_text = lazyCleanText(raw_text, text_obj.ms_text_starts, text_obj.ms_text_ends, arrays["clean_starts"],
+                                   arrays["clean_ends"], cache_max_chars=text_obj.clean_cache_max_chars)
+        text_obj.clean_map = cleanTextMap(clean_text, arrays["clean_starts"], arrays["clean_ends"], arrays["map_starts"], arrays["raw_to_clean"])
+        text_obj.build_clean_lens()
+
+# Extensions an OpenITI text file can have - the metadata path may point to a version of the text that has since changed
+TEXT_EXTENSIONS = ['inProgress', 'completed', 'mARkdown']
+
+def resolve_text_path(uri_path):
+    """Return the path of the text file for a metadata path - the path itself if it exists, otherwise the same
+    text with (or without) one of the OpenITI extensions. Returns None if no file is found"""
+    if os.path.isfile(uri_path):
+        return uri_path
+    split_path = uri_path.split(".")
+    if split_path[-1] in TEXT_EXTENSIONS:
+        pre_extension = ".".join(split_path[:-1])
+        if os.path.isfile(pre_extension):
+            return pre_extension
+    else:
+        pre_extension = uri_path
+    for extension in TEXT_EXTENSIONS:
+        potential_path = pre_extension + "." + extension
+        if os.path.isfile(potential_path):
+            return potential_path
+    return None
+
 class openitiCorpus():
     """Take corpus base path and a metadata tsv, create paths. Perform actions
     on those texts as openITI objects"""
-    def __init__ (self, meta_tsv, base_path, language=None, pri_only = True, min_date = 0, max_date = 1500):
-        """Initiate with a dictionary of URI-path pairs"""
+    def __init__ (self, meta_tsv, base_path, language=None, pri_only = True, min_date = 0, max_date = 1500, text_store=None, pool_max_chars=500_000_000):
+        """Initiate with a dictionary of URI-path pairs
+        text_store: optional openitiTextStore used to load the texts fetched with fetch_text
+        pool_max_chars: memory budget (in characters of text held) of the pool of text objects shared by fetch_text"""
 
         meta_df = self.load_and_filter(meta_tsv, language, pri_only, min_date, max_date)
 
         self.path_dict = self.build_path_dict(meta_df, base_path)
+
+        # The filtered metadata - each book's path is checked on the filesystem once, the first time text_index asks for it
+        self.meta_index = meta_df
+        self.resolved_paths = {}
+
+        self.text_store = text_store
+        self.text_pool = OrderedDict()
+        # Every text object handed out that is still referenced somewhere - including those evicted from the pool
+        self.live_texts = weakref.WeakValueDictionary()
+        self.pool_max_chars = pool_max_chars
+        self.pool_stats = {"hits": 0, "misses": 0, "revived": 0, "evictions": 0}
     
     def load_and_filter(self, meta_tsv, language, pri_only, min_date, max_date):
+        """Filter the (cached) metadata index. A min_date or max_date of None leaves the dates unfiltered"""
         
-        meta_df = pd.read_csv(meta_tsv, sep="\t")
+        meta_df = read_meta_index(meta_tsv)
         
         if pri_only:
             meta_df = meta_df[meta_df["status"]=="pri"]
@@ -543,8 +1262,10 @@ class openitiCorpus():
             meta_df = meta_df[meta_df["language"] == language]
         
         
-        meta_df = meta_df[meta_df["date"].ge(min_date)]
-        meta_df = meta_df[meta_df["date"].le(max_date)]
+        if min_date is not None:
+            meta_df = meta_df[meta_df["date"].ge(min_date)]
+        if max_date is not None:
+            meta_df = meta_df[meta_df["date"].le(max_date)]
 
         return meta_df
         
@@ -567,6 +1288,26 @@ class openitiCorpus():
             path_dict[meta["book"]] = full_path
         
         return path_dict
+
+    def text_index(self, books=None):
+        """Return the filtered metadata (only the rows of books, if given) with, for each book, its path (full_path),
+        the path of the file found for it (resolved_path - None if there is none, see resolve_text_path), whether it was
+        found (exists) and its size in bytes (file_size). Only the books asked for are checked on the filesystem, and
+        each book only the first time"""
+        text_index = self.meta_index
+        if books is not None:
+            text_index = text_index[text_index["book"].isin(books)]
+        text_index = text_index.copy()
+        text_index["full_path"] = text_index["book"].map(self.path_dict)
+        for book, path in zip(text_index["book"], text_index["full_path"]):
+            if book not in self.resolved_paths:
+                resolved = resolve_text_path(path)
+                self.resolved_paths[book] = (resolved, os.path.getsize(resolved) if resolved is not None else 0)
+        resolved = [self.resolved_paths[book] for book in text_index["book"]]
+        text_index["resolved_path"] = pd.Series([path for path, _ in resolved], index=text_index.index, dtype=object)
+        text_index["exists"] = text_index["resolved_path"].notna()
+        text_index["file_size"] = [size for _, size in resolved]
+        return text_index
     
     def return_path_list(self):
         """Take the values of the path dict and return them as a list of paths"""
@@ -598,6 +1339,55 @@ class openitiCorpus():
                 print("URI not found in the metadata: {uri}") 
                 print("Provide a valid URI or set allow_new_uris to True")
                 exit()
+            # A pooled object (and the resolved path) for the URI is of the old path
+            self.text_pool.pop(uri, None)
+            self.live_texts.pop(uri, None)
+            self.resolved_paths.pop(uri, None)
+
+    def fetch_text(self, uri):
+        """Return the openitiTextMs for a URI from a pool shared by every caller. The least recently fetched texts are
+        dropped from the pool when the text it holds exceeds pool_max_chars (the text just fetched is always kept).
+        A dropped text that a caller still holds is returned to the pool as it is rather than read again - a text is
+        only re-read once no caller holds it"""
+        if uri in self.text_pool:
+            self.text_pool.move_to_end(uri)
+            self.pool_stats["hits"] += 1
+            text_obj = self.text_pool[uri]
+        else:
+            text_obj = self.live_texts.get(uri)
+            if text_obj is not None:
+                self.pool_stats["revived"] += 1
+            else:
+                self.pool_stats["misses"] += 1
+                text_obj = openitiTextMs(self.path_dict[uri], text_store=self.text_store)
+                self.live_texts[uri] = text_obj
+            self.text_pool[uri] = text_obj
+        self.evict_texts()
+        return text_obj
+
+    def evict_texts(self):
+        """Drop the least recently fetched texts until the pool is within its budget. Sizes are taken on
+        each call as pooled objects grow as they are used (caches, decoded text)"""
+        sizes = {uri: text_obj.resident_chars() for uri, text_obj in self.text_pool.items()}
+        total = sum(sizes.values())
+        while total > self.pool_max_chars and len(self.text_pool) > 1:
+            uri, text_obj = self.text_pool.popitem(last=False)
+            text_obj.close()
+            total -= sizes[uri]
+            self.pool_stats["evictions"] += 1
+
+    def pool_info(self):
+        """Return the hit/miss/revived/eviction counts and current size of the text pool"""
+        info = dict(self.pool_stats)
+        info.update({"pooled_texts": len(self.text_pool),
+                     "pooled_chars": sum(text_obj.resident_chars() for text_obj in self.text_pool.values()),
+                     "max_chars": self.pool_max_chars})
+        return info
+
+    def clear_pool(self):
+        for text_obj in self.text_pool.values():
+            text_obj.close()
+        self.text_pool = OrderedDict()
                 
 
 
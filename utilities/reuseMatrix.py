@@ -0,0 +1,129 @@
+from scipy import sparse
+import pandas as pd
+import numpy as np
+import json
+import re
+import os
+
+# The measures stored for each pair of books - the same as the columns of clusterDf.calculate_reuse_stats
+MEASURES = ["length", "instances", "clusters", "milestones"]
+
+class reuseMatrix():
+    """Sparse book x book matrices of text reuse. For each measure, row x column r holds the reuse of book r in the
+    clusters it shares with book x (e.g. for 'length' the total length of r's aligned passages), so the top reusers of
+    a book are a single row of the matrix"""
+    def __init__ (self, books, matrices, params):
+        """books: list of book URIs in matrix order
+        matrices: {measure: scipy csr_matrix}
+        params: the options used to build the matrices"""
+        self.books = books
+        self.book_index = {book: idx for idx, book in enumerate(books)}
+        self.matrices = matrices
+        self.params = params
+
+    def top_reusers(self, uri, by = "length", top = None):
+        """Return the reusers of uri as a df with the same columns as clusterDf.calculate_reuse_stats"""
+        idx = self.book_index.get(uri)
+        if idx is None:
+            print("URI not in the reuse matrix: {}".format(uri))
+            return pd.DataFrame(columns=["uri"] + MEASURES)
+        rows = {measure: self.matrices[measure][idx] for measure in MEASURES}
+        columns = rows["clusters"].indices
+        stats_df = pd.DataFrame({"uri": [self.books[col] for col in columns]})
+        for measure in MEASURES:
+            # Every measure is non-zero for exactly the same pairs - align each on the column positions of 'clusters'
+            row = rows[measure].toarray().ravel()
+            stats_df[measure] = row[columns]
+        stats_df = stats_df.sort_values(by=by, ascending=False)
+        if top is not None:
+            stats_df = stats_df.head(top)
+        return stats_df.reset_index(drop=True)
+
+    def save(self, out_dir):
+        """Write the matrices as plain .npy arrays (so they can be loaded memory mapped) with the book list and params as json"""
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for measure, matrix in self.matrices.items():
+            for part in ["data", "indices", "indptr"]:
+                np.save(os.path.join(out_dir, f"{measure}_{part}.npy"), getattr(matrix, part))
+        meta = {"books": self.books, "params": self.params}
+        with open(os.path.join(out_dir, "reuse_matrix.json"), "w", encoding='utf-8') as f:
+            f.write(json.dumps(meta, ensure_ascii=False, indent=2))
+
+def load_reuse_matrix(in_dir, mmap = True):
+    """Load a reuseMatrix written by reuseMatrix.save. If mmap the arrays are memory mapped rather than read into memory"""
+    with open(os.path.join(in_dir, "reuse_matrix.json"), encoding='utf-8') as f:
+        meta = json.load(f)
+    mmap_mode = "r" if mmap else None
+    shape = (len(meta["books"]), len(meta["books"]))
+    matrices = {}
+    for measure in MEASURES:
+        parts = [np.load(os.path.join(in_dir, f"{measure}_{part}.npy"), mmap_mode=mmap_mode) for part in ["data", "indices", "indptr"]]
+        matrices[measure] = sparse.csr_matrix(tuple(parts), shape=shape, copy=False)
+    return reuseMatrix(meta["books"], matrices, meta["params"])
+
+def _mask_matrix(matrix, keep):
+    """Keep only the entries of a sparse matrix for which keep(rows, cols) is True"""
+    coo = matrix.tocoo()
+    mask = keep(coo.row, coo.col)
+    return sparse.csr_matrix((coo.data[mask], (coo.row[mask], coo.col[mask])), shape=matrix.shape)
+
+def build_reuse_matrix(cluster_df, dir = "bi", exclude_self_reuse = False):
+    """Build a reuseMatrix from a cluster df in one pass, using sparse products of book x cluster incidence matrices:
+    P (book x cluster, 1 if the book is in the cluster), and the length and row count of each book in each cluster.
+    length = P @ lengths.T, instances = P @ counts.T, clusters = P @ P.T
+    milestones counts, for each book r, the distinct milestones of r that are in any cluster shared with book x
+    dir: 'bi', 'anachron' (only keep reusers that died before the book) or 'chron' (only those that died after)
+    exclude_self_reuse: drop pairs of books by the same author. Pairs of a book with itself are always dropped"""
+    print("Building book x book reuse matrix")
+    columns = ["book", "cluster", "seq", "begin", "end"]
+    if dir != "bi":
+        columns.append("date")
+    df = cluster_df[columns]
+    book_codes, books = pd.factorize(df["book"].astype(object))
+    cluster_codes, clusters = pd.factorize(df["cluster"])
+    n_books = len(books)
+    n_clusters = len(clusters)
+    lengths = (df["end"] - df["begin"]).to_numpy(dtype=np.int64)
+    ones = np.ones(len(df), dtype=np.int64)
+
+    # Duplicate (row, col) entries are summed when converting to csr
+    length_bc = sparse.csr_matrix((lengths, (book_codes, cluster_codes)), shape=(n_books, n_clusters))
+    count_bc = sparse.csr_matrix((ones, (book_codes, cluster_codes)), shape=(n_books, n_clusters))
+    presence_bc = count_bc.copy()
+    presence_bc.data[:] = 1
+
+    matrices = {"length": (presence_bc @ length_bc.T).tocsr(),
+                "instances": (presence_bc @ count_bc.T).tocsr(),
+                "clusters": (presence_bc @ presence_bc.T).tocsr()}
+
+    # Milestones: (book, ms) x cluster presence -> which (book, ms) share a cluster with each book -> count per book
+    ms_codes, book_ms = pd.factorize(pd.MultiIndex.from_arrays([book_codes, df["seq"].to_numpy()]))
+    ms_cluster = sparse.csr_matrix((np.ones(len(df), dtype=np.int64), (ms_codes, cluster_codes)), shape=(len(book_ms), n_clusters))
+    ms_shared = (ms_cluster @ presence_bc.T).tocsr()
+    ms_shared.data[:] = 1
+    ms_book = sparse.csr_matrix((np.ones(len(book_ms), dtype=np.int64), (book_ms.get_level_values(0), np.arange(len(book_ms)))), shape=(n_books, len(book_ms)))
+    matrices["milestones"] = (ms_book @ ms_shared).T.tocsr()
+
+    # Masks applied to every measure so that all matrices have the same sparsity pattern
+    authors = np.array([book.split(".")[0] for book in books])
+    uri_dates = np.array([int(re.findall(r"\d+", book)[0]) for book in books])
+    if dir != "bi":
+        book_dates = df["date"].groupby(book_codes).first().to_numpy()
+
+    def keep(rows, cols):
+        mask = rows != cols
+        if exclude_self_reuse:
+            mask &= authors[rows] != authors[cols]
+        if dir == "anachron":
+            mask &= book_dates[cols] < uri_dates[rows]
+        elif dir == "chron":
+            mask &= book_dates[cols] > uri_dates[rows]
+        return mask
+
+    for measure in MEASURES:
+        matrices[measure] = _mask_matrix(matrices[measure], keep)
+        matrices[measure].sort_indices()
+
+    params = {"dir": dir, "exclude_self_reuse": exclude_self_reuse}
+    return reuseMatrix(list(books), matrices, params)